@@ -0,0 +1,152 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import subprocess
+from datetime import datetime, timezone
+
+from synthetic_dataset import generate_dataset, DESIGNATORS
+from spa_patch_creator import SpaPatchCreator
+from spa_converter import SpaConverter
+from data_splitter import DataSplitter
+from hsi_clahe_converter import HsiClaheConverter
+from instrumentation import peak_rss_mb
+
+# stages in the order they run and the stages whose output they read
+STAGES = ("patch", "convert", "split", "clahe")
+_DEPENDS = {"convert": "patch", "split": "convert"}
+
+
+def run_stage(stage:str, work_dir:str, patch_size:int, workers:int)->dict:
+    """
+    Run one stage on the benchmark dataset and measure it. Called in a fresh process per stage,
+    so the peak memory belongs to the stage alone.
+
+    :param stage: name of the stage.
+    :param work_dir: directory with the synthetic dataset, all paths are relative to it.
+    :param patch_size: size of the patches.
+    :param workers: number of workers of the stage.
+    :return: number of processed items, run time, throughput and peak memory of the stage process and its workers.
+    """
+    os.chdir(work_dir)
+    names = {name: idx for idx, name in enumerate(DESIGNATORS)}
+    start = time.perf_counter()
+    if stage == "patch":
+        items = len(os.listdir("raw/ann"))
+        SpaPatchCreator("raw/ann", "raw/img", "patches", patch_size, workers=workers).split()
+    elif stage == "convert":
+        items = len(os.listdir("patches/ann"))
+        SpaConverter("patches/ann", "patches/img", "yolo", names, workers=workers).convert()
+    elif stage == "split":
+        items = len(os.listdir("yolo/images"))
+        DataSplitter("yolo", "dataset", 0.2, seed=0).split()
+    elif stage == "clahe":
+        items = len(os.listdir("raw/img"))
+        HsiClaheConverter("raw/img", "clahe", 2.0, workers=workers).convert()
+    else:
+        raise ValueError(f"Unknown stage: {stage}")
+    seconds = time.perf_counter() - start
+    return {"items": items, "seconds": seconds, "items_per_s": items / seconds if seconds > 0 else 0.0, "peak_rss_mb": peak_rss_mb(children=True)}
+
+
+def run_benchmark(work_dir:str, boards:int, width:int, height:int, polygons:int, vertices:int, patch_size:int, workers:int,
+                  stages:tuple=STAGES, seed:int=0)->dict:
+    """
+    Generate a synthetic dataset and measure every stage in its own process.
+
+    :param work_dir: directory for the dataset and the outputs, it is cleared first.
+    :param boards: number of boards.
+    :param width: width of the board images.
+    :param height: height of the board images.
+    :param polygons: number of polygons per board.
+    :param vertices: number of vertices per polygon.
+    :param patch_size: size of the patches.
+    :param workers: number of workers of the stages.
+    :param stages: stages to measure, the stages they depend on are run as well.
+    :param seed: seed of the dataset.
+    :return: benchmark record with the parameters and the measurements per stage.
+    """
+    if os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+    params = {"boards": boards, "width": width, "height": height, "polygons": polygons, "vertices": vertices,
+              "patch_size": patch_size, "workers": workers, "seed": seed}
+    generate_dataset(os.path.join(work_dir, "raw"), boards, seed, width=width, height=height, polygons=polygons, vertices=vertices)
+
+    # every stage runs in a fresh interpreter, the repository stays importable through the path
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)), os.environ.get("PYTHONPATH")])))
+    needed = set()
+    for stage in stages:
+        while stage is not None and stage not in needed:
+            needed.add(stage)
+            stage = _DEPENDS.get(stage)
+
+    results = {}
+    for stage in (stage for stage in STAGES if stage in needed):
+        command = [sys.executable, os.path.abspath(__file__), "--stage", stage, "--work-dir", os.path.abspath(work_dir),
+                   "--patch-size", str(patch_size), "--workers", str(workers)]
+        output = subprocess.run(command, env=env, check=True, capture_output=True, text=True).stdout
+        if stage in stages:
+            results[stage] = json.loads(output.strip().splitlines()[-1])
+
+    return {"time": datetime.now(timezone.utc).isoformat(timespec="seconds"), "commit": _git_commit(),
+            "python": platform.python_version(), "params": params, "stages": results}
+
+
+def _git_commit()->str|None:
+    """
+    Get the commit of the repository, so results can be related to code changes.
+
+    :return: commit hash, None outside of a git checkout.
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv:list[str]=None)->None:
+    """
+    Run the benchmark from the command line, print the results and append them to a results file.
+
+    :param argv: command line arguments, defaults to sys.argv.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the conversion stages on a synthetic S3A dataset.")
+    parser.add_argument("--work-dir", default="bench_work")
+    parser.add_argument("--results", default="bench_results.jsonl", help="file the results are appended to")
+    parser.add_argument("--boards", type=int, default=4)
+    parser.add_argument("--width", type=int, default=4000)
+    parser.add_argument("--height", type=int, default=3000)
+    parser.add_argument("--polygons", type=int, default=500)
+    parser.add_argument("--vertices", type=int, default=16)
+    parser.add_argument("--patch-size", type=int, default=640)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--stages", default=",".join(STAGES), help="comma separated stages to measure")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stage", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    # a single stage in a child process of the benchmark
+    if args.stage is not None:
+        print(json.dumps(run_stage(args.stage, args.work_dir, args.patch_size, args.workers)))
+        return
+
+    stages = tuple(args.stages.split(","))
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"Unknown stages: {', '.join(sorted(unknown))}")
+    record = run_benchmark(args.work_dir, args.boards, args.width, args.height, args.polygons, args.vertices,
+                           args.patch_size, args.workers, stages, args.seed)
+
+    print(f"{'stage':<10}{'items':>8}{'seconds':>10}{'items/s':>10}{'peak MiB':>10}")
+    for stage, stats in record["stages"].items():
+        print(f"{stage:<10}{stats['items']:>8}{stats['seconds']:>10.2f}{stats['items_per_s']:>10.2f}{stats['peak_rss_mb']:>10.0f}")
+    with open(args.results, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+import os
+import json
+import hashlib
+
+
+class BuildManifest:
+    """
+    On-disk record of the inputs and outputs of a conversion run, used to skip unchanged inputs on reruns.
+    """
+
+    FILE_NAME = ".build_manifest.json"
+
+    def __init__(self, output_dir:str, params:dict):
+        """
+        Load the manifest of the output directory. If the parameters changed since the last run,
+        all recorded outputs are deleted and everything is rebuilt.
+
+        :param output_dir: path to the output directory.
+        :param params: parameters of the run that influence the outputs, must be JSON serializable.
+        """
+        self.path = os.path.join(output_dir, self.FILE_NAME)
+        self.params = json.loads(json.dumps(params))
+        self.entries = {}
+
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                stored = json.load(f)
+            if stored["params"] == self.params:
+                self.entries = stored["entries"]
+            else:
+                for entry in stored["entries"].values():
+                    self._delete_outputs(entry)
+
+    def pending(self, keys:list[str])->list[str]:
+        """
+        Get the keys that have to be rebuilt. Outputs of changed keys and of keys whose inputs
+        disappeared are deleted.
+
+        :param keys: keys of the current inputs.
+        :return: keys whose inputs are new or changed.
+        """
+        self.remove_missing(keys)
+        pending = [key for key in keys if not self.is_current(key)]
+        for key in pending:
+            self.invalidate(key)
+        return pending
+
+    def update(self, keys:list[str], results:list)->None:
+        """
+        Record the results of a run and save the manifest. Keys without a result are left out so they are retried.
+
+        :param keys: keys that were processed.
+        :param results: per key a tuple of input and output paths, None for failed keys.
+        """
+        for key, result in zip(keys, results):
+            if result is not None:
+                self.record(key, *result)
+        self.save()
+
+    def is_current(self, key:str)->bool:
+        """
+        Check if the inputs of a key are unchanged since they were recorded.
+        Files with a new modification time are hashed, an unchanged hash only updates the time.
+
+        :param key: key of the entry, usually the path of the main input file.
+        :return: True if the recorded outputs are still valid.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return False
+
+        for record in entry["inputs"]:
+            try:
+                stat = os.stat(record["path"])
+            except FileNotFoundError:
+                return False
+            if stat.st_size != record["size"]:
+                return False
+            if stat.st_mtime_ns != record["mtime_ns"]:
+                if self._hash_file(record["path"]) != record["hash"]:
+                    return False
+                record["mtime_ns"] = stat.st_mtime_ns
+
+        return all(os.path.exists(output) for output in entry["outputs"])
+
+    def invalidate(self, key:str)->None:
+        """
+        Delete the recorded outputs of a key and forget the key.
+
+        :param key: key of the entry.
+        """
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self._delete_outputs(entry)
+
+    def record(self, key:str, inputs:list[str], outputs:list[str])->None:
+        """
+        Record the inputs and the outputs they produced.
+
+        :param key: key of the entry.
+        :param inputs: paths of the input files.
+        :param outputs: paths of the output files.
+        """
+        records = []
+        for path in inputs:
+            stat = os.stat(path)
+            records.append({"path": path, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hash": self._hash_file(path)})
+        self.entries[key] = {"inputs": records, "outputs": list(outputs)}
+
+    def remove_missing(self, keys:list[str])->None:
+        """
+        Delete the outputs of all recorded keys that are not among the current inputs.
+
+        :param keys: keys of the current inputs.
+        """
+        for key in set(self.entries) - set(keys):
+            self.invalidate(key)
+
+    def save(self)->None:
+        """
+        Write the manifest to the output directory.
+        """
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump({"params": self.params, "entries": self.entries}, f)
+        os.replace(temp_path, self.path)
+
+    def _delete_outputs(self, entry:dict)->None:
+        """
+        Delete the outputs of an entry.
+
+        :param entry: the manifest entry.
+        """
+        for output in entry["outputs"]:
+            if os.path.exists(output):
+                os.remove(output)
+
+    def _hash_file(self, path:str)->str:
+        """
+        Hash the content of a file.
+
+        :param path: path to the file.
+        :return: hex digest of the content.
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
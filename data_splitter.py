@@ -1,34 +1,198 @@
 import os
+import hashlib
+import re
 import numpy as np
 from glob import glob
-import shutil
 from sklearn.model_selection import train_test_split
 
+from file_linker import link_file
+from instrumentation import Profiler
+from dataset_yaml import write_dataset_yaml, read_dataset_names
+
+# patches are named {image}_{n}
+_PATCH_NAME = re.compile(r"^(.*)_\d+$")
+
 class DataSplitter:
-    def __init__(self, input_path:str, output_path:str, test_size:str):
+    def __init__(self, input_path:str, output_path:str, test_size:str, link_mode:str="copy", mode:str="random", splits:dict=None, seed:int=None, profile:str=None,
+                 names:dict=None):
         """
         :param input_path: path to the input directory.
         :param output_path: path to the output directory.
         :param test_size: size of the test set.
+        :param link_mode: how files are placed in the output directory, "copy", "hardlink", "symlink" or "reflink".
+        :param mode: "random" splits shuffled file lists, "hash" pairs images and labels by name and
+            assigns every pair by a stable hash of its name while scanning the input directory,
+            "group" keeps all patches of one source image in the same split and balances the
+            splits by patch and instance counts.
+        :param splits: fractions of the splits for the "hash" and "group" modes, e.g. {"train": 0.7, "val": 0.2, "test": 0.1}.
+            Defaults to train and val according to test_size.
+        :param seed: random state of the "random" mode and salt of the hash in the "hash" mode.
+        :param profile: path of a JSON report with the time, files and bytes of every phase, None disables the instrumentation.
+        :param names: dictionary containing the class names and their corresponding class ids for the yaml file of the
+            split dataset. Defaults to the classes of the yaml file in the input directory (see SpaConverter),
+            without either no yaml file is written.
         """
+        if mode not in ("random", "hash", "group"):
+            raise ValueError(f"Unknown split mode: {mode}")
+        if splits is None:
+            splits = {"train": 1 - test_size, "val": test_size}
+        elif mode == "random":
+            raise ValueError("Custom splits require the hash or group mode")
+        if not np.isclose(sum(splits.values()), 1.0):
+            raise ValueError(f"Split fractions must sum up to 1: {splits}")
+
         self.input_path = input_path
         self.output_path = output_path
         self.test_size = test_size
+        self.link_mode = link_mode
+        self.mode = mode
+        self.splits = splits
+        self.seed = seed
+        self.profiler = Profiler(profile)
+        self.names = names
 
     def split(self):
         """
         Split the data into train and test sets.
+
+        :return: number of images per split.
         """
-        
-        # read the directory
-        label_files, image_files = self._read_directory(self.input_path)
+        self.profiler.start()
 
         # create the directories
         self._create_directories(self.output_path)
-        
-        # split the data
-        self._split_data(label_files, image_files, self.test_size)
-        
+
+        if self.mode == "hash":
+            # assign and copy every pair while scanning the input directory
+            counts = self._split_streaming(self.input_path)
+        elif self.mode == "group":
+            # keep the patches of every source image together
+            counts = self._split_grouped(self.input_path)
+        else:
+            # read the directory
+            with self.profiler.phase("scan"):
+                label_files, image_files = self._read_directory(self.input_path)
+
+            # split the data
+            counts = self._split_data(label_files, image_files, self.test_size)
+
+        # the yaml file points YOLO at the split directories
+        names = self.names if self.names is not None else read_dataset_names(self.input_path)
+        if names is not None:
+            write_dataset_yaml(self.output_path, {split: f"{split}/images" for split in self.splits}, names)
+
+        self.profiler.finish(splits=counts)
+        return counts
+
+    def _split_streaming(self, input_path:str)->dict:
+        """
+        Pair images and labels by name and copy every pair to the split chosen by the hash of its name.
+        Files are processed while the directory is scanned, so memory stays constant, and adding
+        files never moves existing ones to another split.
+
+        :param input_path: path to the input directory.
+        :return: number of images per split.
+        """
+        label_dir = os.path.join(input_path, "labels")
+        image_dir = os.path.join(input_path, "images")
+        counts = dict.fromkeys(self.splits, 0)
+
+        with os.scandir(image_dir) as entries:
+            for entry in entries:
+                if not entry.is_file() or entry.name.startswith("."):
+                    continue
+
+                # pair the image with the label of the same name, images without objects have none
+                stem = os.path.splitext(entry.name)[0]
+                split = self._assign_split(stem)
+                self._insert_file(entry.path, f"{self.output_path}/{split}/images")
+                label = os.path.join(label_dir, stem + ".txt")
+                if os.path.exists(label):
+                    self._insert_file(label, f"{self.output_path}/{split}/labels")
+                counts[split] += 1
+        return counts
+
+    def _split_grouped(self, input_path:str)->dict:
+        """
+        Split the data by source image. The group of a patch named {image}_{n} is {image}.
+        Patch and instance counts are gathered in a single scan of the label files.
+
+        :param input_path: path to the input directory.
+        :return: number of images per split.
+        """
+        label_dir = os.path.join(input_path, "labels")
+        image_dir = os.path.join(input_path, "images")
+
+        # gather the images with their label and instance count per group
+        groups = {}
+        with os.scandir(image_dir) as entries:
+            for entry in entries:
+                if not entry.is_file() or entry.name.startswith("."):
+                    continue
+                stem = os.path.splitext(entry.name)[0]
+                label = os.path.join(label_dir, stem + ".txt")
+                with self.profiler.phase("count_instances") as phase:
+                    instances = None
+                    if os.path.exists(label):
+                        instances = self._count_instances(label)
+                        phase.read(label)
+
+                match = _PATCH_NAME.match(stem)
+                group = match.group(1) if match else stem
+                groups.setdefault(group, []).append((entry.path, label, instances))
+
+        # copy or link every group to its split
+        assignment = self._balance_groups(groups)
+        counts = dict.fromkeys(self.splits, 0)
+        for group, samples in groups.items():
+            split = assignment[group]
+            for image, label, instances in samples:
+                self._insert_file(image, f"{self.output_path}/{split}/images")
+                if instances is not None:
+                    self._insert_file(label, f"{self.output_path}/{split}/labels")
+            counts[split] += len(samples)
+        return counts
+
+    def _balance_groups(self, groups:dict)->dict:
+        """
+        Assign the groups to the splits. Starting with the largest group, every group goes to the split
+        that is furthest below its target share of patches and instances.
+
+        :param groups: samples per group as (image, label, instances) tuples.
+        :return: split per group.
+        """
+        names = list(self.splits)
+        sizes = {group: np.array([len(samples), sum(instances or 0 for _, _, instances in samples)]) for group, samples in groups.items()}
+        totals = np.maximum(sum(sizes.values(), np.zeros(2)), 1)
+        targets = np.array(list(self.splits.values()))[:, None] * totals
+        current = np.zeros_like(targets)
+
+        assignment = {}
+        for group in sorted(sizes, key=lambda group: (-sizes[group][0], -sizes[group][1], group)):
+            deficit = ((targets - current) / totals).sum(axis=1)
+            split = int(np.argmax(deficit))
+            current[split] += sizes[group]
+            assignment[group] = names[split]
+        return assignment
+
+    def _count_instances(self, label_path:str)->int:
+        """
+        Count the objects in a label file.
+
+        :param label_path: path to the label file.
+        :return: number of non-empty lines.
+        """
+        with open(label_path, "rb") as f:
+            return sum(1 for line in f if line.strip())
+
+    def _assign_split(self, name:str)->str:
+        """
+        Choose a split for a name from a stable hash of the name.
+
+        :param name: name of the sample.
+        :return: name of the split.
+        """
+        return assign_split(name, self.splits, self.seed)
 
     def _read_directory(self, input_path:str):
         """
@@ -52,11 +216,9 @@ class DataSplitter:
         :param output_dir: path to the output directory.
         """
         # create the output directories
-        if not os.path.exists(output_dir):
-            os.makedirs(self.output_path + "/train/images", exist_ok=True)
-            os.makedirs(self.output_path + "/train/labels", exist_ok=True)
-            os.makedirs(self.output_path + "/val/images", exist_ok=True)
-            os.makedirs(self.output_path + "/val/labels", exist_ok=True)
+        for split in self.splits:
+            os.makedirs(output_dir + f"/{split}/images", exist_ok=True)
+            os.makedirs(output_dir + f"/{split}/labels", exist_ok=True)
 
     def _split_data(self, label_files:list[str], image_files:list[str], test_size:float):
         """
@@ -65,12 +227,13 @@ class DataSplitter:
         :param label_files: list of label files.
         :param image_files: list of image files.
         :param test_size: size of the test set.
+        :return: number of images per split.
         """
         # create the indices
         idx = list(range(len(label_files)))
 
         # split the indices into train and test sets
-        train_idx, test_idx = train_test_split(idx, test_size=test_size)
+        train_idx, test_idx = train_test_split(idx, test_size=test_size, random_state=self.seed)
 
         # split the data into train and test sets based on the indices
         train_labels = [label_files[i] for i in train_idx]
@@ -79,12 +242,47 @@ class DataSplitter:
         train_images = [image_files[i] for i in train_idx]
         test_images = [image_files[i] for i in test_idx]
 
-        # copy the files to the output directory
+        # copy or link the files to the output directory
         for label in train_labels:
-            shutil.copy(label, self.output_path + "/train/labels")
+            self._insert_file(label, self.output_path + "/train/labels")
         for label in test_labels:
-            shutil.copy(label, self.output_path + "/val/labels")
+            self._insert_file(label, self.output_path + "/val/labels")
         for image in train_images:
-            shutil.copy(image, self.output_path + "/train/images")
+            self._insert_file(image, self.output_path + "/train/images")
         for image in test_images:
-            shutil.copy(image, self.output_path + "/val/images")
\ No newline at end of file
+            self._insert_file(image, self.output_path + "/val/images")
+        return {"train": len(train_idx), "val": len(test_idx)}
+
+    def _insert_file(self, src:str, dst_dir:str):
+        """
+        Insert a file into an output directory according to the link mode.
+
+        :param src: path to the file.
+        :param dst_dir: path to the destination directory.
+        """
+        with self.profiler.phase("insert") as phase:
+            dst = link_file(src, os.path.join(dst_dir, os.path.basename(src)), self.link_mode)
+            phase.wrote(dst)
+
+
+def assign_split(name:str, splits:dict, seed:int=None)->str:
+    """
+    Choose a split for a name from a stable hash of the name.
+    The same name always ends up in the same split, independent of the other names.
+
+    :param name: name of the sample.
+    :param splits: fractions of the splits, e.g. {"train": 0.8, "val": 0.2}.
+    :param seed: salt of the hash.
+    :return: name of the split.
+    """
+    key = name if seed is None else f"{seed}:{name}"
+    digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+    position = int.from_bytes(digest, "big") / 2**64
+
+    # walk the cumulative fractions of the splits
+    cumulative = 0.0
+    for split, fraction in splits.items():
+        cumulative += fraction
+        if position < cumulative:
+            return split
+    return split
@@ -0,0 +1,207 @@
+import io
+import os
+import json
+import time
+import tarfile
+from glob import glob
+
+
+class ShardWriter:
+    """
+    Pack files into size bounded tar shards, written sequentially. Every shard gets an index
+    with the position of every member, so single members can be read without scanning the tar.
+    Members added one after another with the same sample key form a sample, like in WebDataset,
+    and are never split across shards. The key defaults to the name stem of the member.
+    """
+
+    def __init__(self, output_dir:str, prefix:str="shard", max_bytes:int=1 << 30):
+        """
+        Existing shards with the same prefix are deleted.
+
+        :param output_dir: path to the output directory.
+        :param prefix: name of the shards, followed by their number.
+        :param max_bytes: size at which a shard is closed and the next one started,
+            a shard exceeds it only by the rest of its last sample.
+        """
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.shards = []
+        self._tar = None
+        self._index = []
+        self._sample = None
+
+        os.makedirs(output_dir, exist_ok=True)
+        for path in list_shards(output_dir, prefix):
+            os.remove(path)
+            if os.path.exists(index_path(path)):
+                os.remove(index_path(path))
+
+    def add(self, name:str, data:bytes, sample:str=None)->None:
+        """
+        Append a file to the current shard, a full shard is closed first unless the file
+        belongs to the same sample as the previous one.
+
+        :param name: name of the member, e.g. images/board_0.png.
+        :param data: content of the file.
+        :param sample: key of the sample the file belongs to, defaults to its name without directory and extension.
+        """
+        if sample is None:
+            sample = os.path.splitext(os.path.basename(name))[0]
+        if self._tar is not None and self._tar.offset + len(data) > self.max_bytes and sample != self._sample:
+            self._close_shard()
+        self._sample = sample
+        if self._tar is None:
+            path = os.path.join(self.output_dir, f"{self.prefix}-{len(self.shards):05d}.tar")
+            self._tar = tarfile.open(path, "w", format=tarfile.GNU_FORMAT)
+            self.shards.append(path)
+
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        self._tar.addfile(info, io.BytesIO(data))
+
+        # the data ends padded to the block size at the current offset
+        padded = -(-len(data) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        self._index.append([name, self._tar.offset - padded, len(data)])
+
+        # members are only needed for reading, dropping them keeps the memory constant
+        self._tar.members.clear()
+
+    def close(self)->list[str]:
+        """
+        Close the last shard.
+
+        :return: paths of all written shards.
+        """
+        if self._tar is not None:
+            self._close_shard()
+        return self.shards
+
+    def _close_shard(self)->None:
+        """
+        Close the current shard and write its index next to it.
+        """
+        self._tar.close()
+        with open(index_path(self.shards[-1]), "w") as f:
+            json.dump({"members": self._index}, f)
+        self._tar = None
+        self._index = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+class ShardReader:
+    """
+    Read the members of one tar shard through its index.
+    """
+
+    def __init__(self, shard_path:str):
+        """
+        :param shard_path: path to the shard.
+        """
+        self.shard_path = shard_path
+        with open(index_path(shard_path)) as f:
+            members = json.load(f)["members"]
+        self._names = [name for name, _, _ in members]
+        self._positions = {name: (offset, size) for name, offset, size in members}
+
+    def names(self)->list[str]:
+        """
+        Get the names of the members in the order they were written.
+
+        :return: member names.
+        """
+        return list(self._names)
+
+    def read(self, name:str)->bytes:
+        """
+        Read a single member.
+
+        :param name: name of the member.
+        :return: content of the member.
+        """
+        offset, size = self._positions[name]
+        with open(self.shard_path, "rb") as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def __iter__(self):
+        """
+        Iterate over all members in one sequential pass.
+
+        :return: iterator of member names and contents.
+        """
+        with open(self.shard_path, "rb") as f:
+            for name in self._names:
+                offset, size = self._positions[name]
+                f.seek(offset)
+                yield name, f.read(size)
+
+    def extract(self, output_dir:str, names:list[str]=None)->list[str]:
+        """
+        Extract members to a directory, keeping their relative paths.
+
+        :param output_dir: path to the output directory.
+        :param names: names of the members to extract, all members by default.
+        :return: paths of the extracted files.
+        """
+        wanted = set(self._names if names is None else names)
+        paths = []
+        for name, data in self:
+            if name not in wanted:
+                continue
+            path = os.path.join(output_dir, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(data)
+            paths.append(path)
+        return paths
+
+
+def pack_result(writer:ShardWriter, result:tuple, profiler=None)->tuple[list[str], list[str]]:
+    """
+    Append the output files of a task to the shards, e.g. as consume callback of run_tasks.
+
+    :param writer: writer of the shards.
+    :param result: paths of the input files and names and contents of the output files,
+        optionally followed by their sample key (see ShardWriter.add).
+    :param profiler: profiler recording the phase "pack_shards" (see Profiler).
+    :return: paths of the input files and names of the packed files.
+    """
+    inputs, outputs = result
+    if profiler is None:
+        for name, data, *sample in outputs:
+            writer.add(name, data, *sample)
+    else:
+        with profiler.phase("pack_shards") as phase:
+            for name, data, *sample in outputs:
+                writer.add(name, data, *sample)
+                phase.wrote(name, len(data))
+    return inputs, [output[0] for output in outputs]
+
+
+def list_shards(output_dir:str, prefix:str="shard")->list[str]:
+    """
+    List the shards of a directory.
+
+    :param output_dir: path to the directory.
+    :param prefix: name of the shards.
+    :return: sorted paths of the shards.
+    """
+    return sorted(glob(os.path.join(output_dir, f"{prefix}-[0-9]*.tar")))
+
+
+def index_path(shard_path:str)->str:
+    """
+    Get the path of the index of a shard.
+
+    :param shard_path: path to the shard.
+    :return: path to the index.
+    """
+    return os.path.splitext(shard_path)[0] + ".idx.json"
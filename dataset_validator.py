@@ -0,0 +1,349 @@
+import os
+import argparse
+
+import numpy as np
+
+from process_pool import run_tasks
+from spa_vertices import convert_numbers
+from instrumentation import Profiler
+
+# bytes that separate the values of a label file, like bytes.split
+_WHITESPACE = np.zeros(256, dtype=bool)
+_WHITESPACE[list(b" \t\n\r\x0b\x0c")] = True
+
+
+class DatasetValidator:
+    """
+    Check a YOLO dataset and gather its label statistics. The label files are parsed in chunks
+    spread across the workers, every chunk in one vectorized pass over the joined file contents.
+    Works on the output of SpaConverter (images/ and labels/) and of DataSplitter ({split}/images/ and {split}/labels/).
+    """
+
+    def __init__(self, dataset_dir:str, names:dict=None, workers:int=1, fail_fast:bool=True, allow_background:bool=True,
+                 bins:int=20, chunk_size:int=4096, max_errors:int=100, profile:str=None):
+        """
+        :param dataset_dir: path to the dataset directory.
+        :param names: dictionary containing the class names and their corresponding class ids.
+            Without it class ids are only checked for being non-negative integers.
+        :param workers: number of processes parsing label files in parallel.
+        :param fail_fast: raise a ValueError on the first inconsistency instead of reporting all of them.
+        :param allow_background: images without a label file are background images, otherwise they are an inconsistency.
+        :param bins: number of bins of the instance size histogram.
+        :param chunk_size: number of label files per task.
+        :param max_errors: maximum number of error messages kept in the report, all errors are counted.
+        :param profile: path of a JSON report with the time, files and bytes of every phase, None disables the instrumentation.
+        """
+        self.dataset_dir = dataset_dir
+        self.names = names
+        self.workers = workers
+        self.fail_fast = fail_fast
+        self.allow_background = allow_background
+        self.bins = bins
+        self.chunk_size = chunk_size
+        self.max_errors = max_errors
+        self.profiler = Profiler(profile)
+
+    def validate(self)->dict:
+        """
+        Validate the dataset.
+
+        :return: report with the files, instances and errors per split, the instances per class,
+            a histogram of the instance sizes and a histogram of the polygon vertex counts.
+        """
+        self.profiler.start()
+
+        # pair the images and labels of every split by name
+        with self.profiler.phase("scan"):
+            splits = self._scan_splits(self.dataset_dir)
+        errors = []
+        report = {"splits": {}}
+        for split, (images, labels) in splits.items():
+            backgrounds = images.keys() - labels.keys()
+            orphans = labels.keys() - images.keys()
+            errors += [f"{labels[stem]}: label without image" for stem in sorted(orphans)]
+            if not self.allow_background:
+                errors += [f"{images[stem]}: image without label" for stem in sorted(backgrounds)]
+            report["splits"][split] = {"images": len(images), "labels": len(labels), "backgrounds": len(backgrounds),
+                                       "orphan_labels": len(orphans)}
+
+        # a sample in several splits leaks into the validation
+        seen = {}
+        for split, (images, _) in splits.items():
+            for stem in images:
+                if stem in seen:
+                    errors.append(f"{images[stem]}: also in split {seen[stem]}")
+                seen.setdefault(stem, split)
+        del seen
+        if errors and self.fail_fast:
+            raise ValueError(errors[0])
+
+        # parse the label files in chunks, a chunk never spans two splits
+        chunks, chunk_splits = [], []
+        for split, (_, labels) in splits.items():
+            paths = sorted(labels.values())
+            for start in range(0, len(paths), self.chunk_size):
+                chunks.append(_Chunk(paths[start:start + self.chunk_size]))
+                chunk_splits.append(split)
+        results, failures = run_tasks(self._check_chunk, chunks, self.workers, self.profiler, fail_fast=self.fail_fast)
+
+        # sum up the statistics of the chunks
+        classes = np.zeros(len(self.names) if self.names else 0, dtype=np.int64)
+        sizes = np.zeros(self.bins, dtype=np.int64)
+        vertices = np.zeros(0, dtype=np.int64)
+        error_count = len(errors)
+        for split in splits:
+            report["splits"][split].update(instances=0, empty_labels=0, errors=0)
+        for split, result in zip(chunk_splits, results):
+            if result is None:
+                continue
+            classes = _add_counts(classes, result["classes"])
+            sizes += result["sizes"]
+            vertices = _add_counts(vertices, result["vertices"])
+            errors += result["errors"]
+            error_count += result["error_count"]
+            stats = report["splits"][split]
+            stats["instances"] += result["instances"]
+            stats["empty_labels"] += result["empty_labels"]
+            stats["errors"] += result["error_count"]
+
+        ids = {idx: name for name, idx in self.names.items()} if self.names else {}
+        report["classes"] = {ids.get(idx, idx): int(count) for idx, count in enumerate(classes) if count or idx in ids}
+        report["sizes"] = {"edges": np.linspace(0, 1, self.bins + 1).round(6).tolist(), "counts": sizes.tolist()}
+        report["vertices"] = {idx: int(count) for idx, count in enumerate(vertices) if count}
+        report["errors"] = errors[:self.max_errors]
+        report["error_count"] = error_count
+        report["failures"] = failures
+        self.profiler.finish(error_count=error_count, failures=len(failures))
+        return report
+
+    def _check_chunk(self, paths:"_Chunk")->dict:
+        """
+        Parse and check a chunk of label files.
+
+        :param paths: paths of the label files.
+        :return: statistics and error messages of the chunk.
+        """
+        with self.profiler.phase("read_labels") as phase:
+            contents = []
+            for path in paths:
+                with open(path, "rb") as f:
+                    contents.append(f.read())
+                phase.read(path)
+
+        with self.profiler.phase("parse_labels"):
+            # files are joined by a line break, so no value runs into the next file
+            buffer = b"\n".join(contents)
+            file_starts = np.cumsum([0] + [len(content) + 1 for content in contents[:-1]])
+            file_lines = np.cumsum([0] + [content.count(b"\n") + 1 for content in contents[:-1]])
+            line_starts, line_numbers, classes, counts, coordinates, invalid = parse_labels(buffer)
+            files = np.searchsorted(file_starts, line_starts, side="right") - 1
+            line_numbers -= file_lines[files]
+
+        with self.profiler.phase("check_labels"):
+            stats, messages = self._check_lines(classes, counts, coordinates, invalid)
+            bad = np.flatnonzero(messages != "")
+            errors = [f"{paths[files[line]]}:{line_numbers[line] + 1}: {messages[line]}" for line in bad[:self.max_errors]]
+            if errors and self.fail_fast:
+                raise ValueError(errors[0])
+            stats.update(errors=errors, error_count=len(bad), instances=int(stats["classes"].sum()),
+                         empty_labels=len(paths) - len(np.unique(files)))
+        return stats
+
+    def _check_lines(self, classes:np.ndarray, counts:np.ndarray, coordinates:np.ndarray, invalid:np.ndarray)->tuple[dict, np.ndarray]:
+        """
+        Check the label lines and gather the statistics of the valid ones. A line with 4 coordinates is a box
+        of center, width and height, a line with 6 or more an (x, y) polygon.
+
+        :param classes: (L,) class ids of the lines.
+        :param counts: (L,) number of coordinates of the lines.
+        :param coordinates: (N,) coordinates of all lines.
+        :param invalid: (L,) lines with a value that is no number.
+        :return: per class instance counts, size and vertex histograms, and an error message per line, empty for valid lines.
+        """
+        messages = np.full(len(classes), "", dtype=object)
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        boxes = counts == 4
+        polygons = (counts >= 6) & (counts % 2 == 0)
+
+        # nan or infinite coordinates and coordinates outside of the image, summed per line with a cumulative sum
+        nonfinite = np.concatenate(([0], np.cumsum(~np.isfinite(coordinates))))
+        nonfinite = nonfinite[offsets[1:]] - nonfinite[offsets[:-1]] > 0
+        outside = np.concatenate(([0], np.cumsum((coordinates < 0) | (coordinates > 1))))
+        outside = outside[offsets[1:]] - outside[offsets[:-1]] > 0
+
+        # area of the boxes and of the polygons by the shoelace formula
+        areas = np.zeros(len(classes))
+        point_lines = np.repeat(np.flatnonzero(polygons), counts[polygons] // 2)
+        if len(point_lines):
+            points = coordinates[_ranges(offsets[:-1][polygons], counts[polygons])].reshape(-1, 2)
+            first = np.concatenate(([0], np.cumsum(counts[polygons] // 2)))
+            following = np.arange(1, len(points) + 1)
+            following[first[1:] - 1] = first[:-1]
+            cross = points[:, 0] * points[following, 1] - points[following, 0] * points[:, 1]
+            areas[polygons] = np.abs(np.bincount(point_lines, cross, minlength=len(classes))[polygons]) / 2
+        box_values = coordinates[offsets[:-1][boxes][:, None] + np.arange(4)]
+        areas[boxes] = box_values[:, 2] * box_values[:, 3]
+
+        # the first failed check of a line is its error
+        class_count = len(self.names) if self.names else np.inf
+        checks = [
+            (invalid, "invalid number"),
+            (~(boxes | polygons), "expected 4 box values or an even number of at least 6 polygon values"),
+            ((classes != np.floor(classes)) | (classes < 0) | (classes >= class_count), "invalid class id"),
+            (nonfinite, "nan or infinite coordinates"),
+            (outside, "coordinates outside of [0, 1]"),
+            (~(areas > 0), "degenerate instance without area"),
+        ]
+        for failed, message in reversed(checks):
+            messages[failed] = message
+
+        valid = messages == ""
+        ids = classes[valid].astype(np.int64)
+        stats = {
+            "classes": np.bincount(ids, minlength=len(self.names) if self.names else 0),
+            "sizes": np.histogram(np.sqrt(areas[valid]), bins=self.bins, range=(0, 1))[0],
+            "vertices": np.bincount(counts[valid & polygons] // 2),
+        }
+        return stats, messages
+
+    def _scan_splits(self, dataset_dir:str)->dict:
+        """
+        List the images and labels of every split of the dataset.
+
+        :param dataset_dir: path to the dataset directory.
+        :return: dictionary of the splits with the image and label paths by name, "" for a dataset without splits.
+        """
+        if os.path.isdir(os.path.join(dataset_dir, "images")):
+            split_dirs = {"": dataset_dir}
+        else:
+            split_dirs = {entry.name: entry.path for entry in sorted(os.scandir(dataset_dir), key=lambda entry: entry.name)
+                          if os.path.isdir(os.path.join(entry.path, "images"))}
+        if not split_dirs:
+            raise ValueError(f"No images directory in {dataset_dir}")
+
+        splits = {}
+        for split, split_dir in split_dirs.items():
+            images = self._list_files(os.path.join(split_dir, "images"))
+            labels = self._list_files(os.path.join(split_dir, "labels"))
+            splits[split] = (images, labels)
+        return splits
+
+    def _list_files(self, directory:str)->dict:
+        """
+        List the files of a directory by name without extension.
+
+        :param directory: path to the directory.
+        :return: dictionary of the names and paths, empty if the directory doesn't exist.
+        """
+        if not os.path.isdir(directory):
+            return {}
+        files = {}
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if not entry.is_file() or entry.name.startswith("."):
+                    continue
+                stem = os.path.splitext(entry.name)[0]
+                if stem in files:
+                    raise ValueError(f"Several files named {stem} in {directory}")
+                files[stem] = entry.path
+        return files
+
+
+class _Chunk(tuple):
+    """
+    Paths of the label files of one task, shortened in failure reports.
+    """
+
+    def __str__(self):
+        return f"{self[0]} and {len(self) - 1} more label files"
+
+
+def parse_labels(buffer:bytes)->tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Parse YOLO label lines in one vectorized pass. Every non-empty line starts with a class id followed by coordinates.
+
+    :param buffer: content of one or more label files.
+    :return: position of the first value of every line in the buffer (L,), zero based line numbers (L,), class ids (L,),
+        number of coordinates per line (L,), coordinates of all lines (N,) and lines with a value that is no number (L,).
+    """
+    chars = np.frombuffer(buffer, dtype=np.uint8)
+    space = _WHITESPACE[chars]
+
+    # a value starts at every non-space character that follows a space, lines are counted by line breaks
+    token_pos = np.flatnonzero(~space & np.r_[True, space[:-1]])
+    token_line = np.cumsum(chars == ord("\n"), dtype=np.int32)[token_pos]
+    heads = np.flatnonzero(np.r_[True, token_line[1:] != token_line[:-1]]) if len(token_pos) else np.zeros(0, dtype=np.int64)
+    counts = np.diff(np.append(heads, len(token_pos))) - 1
+
+    values, bad_tokens = convert_numbers(buffer)
+    coordinate = np.ones(len(values), dtype=bool)
+    coordinate[heads] = False
+    invalid = np.bincount(np.repeat(np.arange(len(heads)), counts + 1), bad_tokens, minlength=len(heads)) > 0
+    return token_pos[heads], token_line[heads], values[heads], counts, values[coordinate], invalid
+
+
+def _ranges(starts:np.ndarray, lengths:np.ndarray)->np.ndarray:
+    """
+    Concatenate the index ranges start, ..., start + length - 1.
+
+    :param starts: first index of every range.
+    :param lengths: length of every range.
+    :return: indices of all ranges.
+    """
+    ends = np.cumsum(lengths)
+    return np.arange(ends[-1] if len(ends) else 0) - np.repeat(ends - lengths - starts, lengths)
+
+
+def _add_counts(total:np.ndarray, counts:np.ndarray)->np.ndarray:
+    """
+    Add two count arrays of different lengths.
+
+    :param total: counts so far.
+    :param counts: counts to add.
+    :return: sum of the counts with the length of the longer array.
+    """
+    if len(counts) > len(total):
+        total, counts = counts.astype(np.int64), total
+    total[:len(counts)] += counts
+    return total
+
+
+def main(argv:list[str]=None)->None:
+    """
+    Validate a dataset from the command line and print its statistics. Exits with status 1 if the dataset is inconsistent.
+
+    :param argv: command line arguments, defaults to sys.argv.
+    """
+    parser = argparse.ArgumentParser(description="Check a YOLO dataset and print its label statistics.")
+    parser.add_argument("dataset_dir", help="dataset directory with images/ and labels/ or one such directory per split")
+    parser.add_argument("--names", default=None, help="comma separated class names, the position is the class id")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--no-background", action="store_true", help="treat images without label file as inconsistency")
+    parser.add_argument("--all", action="store_true", help="report all inconsistencies instead of stopping at the first")
+    args = parser.parse_args(argv)
+
+    names = {name: idx for idx, name in enumerate(args.names.split(","))} if args.names else None
+    validator = DatasetValidator(args.dataset_dir, names, args.workers, fail_fast=not args.all, allow_background=not args.no_background)
+    try:
+        report = validator.validate()
+    except ValueError as e:
+        parser.exit(1, f"Invalid dataset: {e}\n")
+
+    print(f"{'split':<10}{'images':>10}{'labels':>10}{'background':>12}{'instances':>12}{'errors':>8}")
+    for split, stats in report["splits"].items():
+        print(f"{split or '.':<10}{stats['images']:>10}{stats['labels']:>10}{stats['backgrounds']:>12}{stats['instances']:>12}{stats['errors']:>8}")
+    print("\ninstances per class")
+    for name, count in report["classes"].items():
+        print(f"  {name:<10}{count:>10}")
+    print("\ninstance size (square root of the area fraction)")
+    edges, counts = report["sizes"]["edges"], report["sizes"]["counts"]
+    for low, high, count in zip(edges, edges[1:], counts):
+        print(f"  {low:.2f}-{high:.2f}{count:>10}")
+    for error in report["errors"]:
+        print(error)
+    if report["error_count"] or report["failures"]:
+        parser.exit(1, f"{report['error_count']} inconsistencies, {len(report['failures'])} unreadable chunks\n")
+
+
+if __name__ == "__main__":
+    main()
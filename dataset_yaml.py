@@ -0,0 +1,56 @@
+import os
+import re
+
+# names list of a dataset yaml file, e.g. names: [R, C, U]
+_NAMES = re.compile(r"^names:\s*\[(.*)\]\s*$", re.MULTILINE)
+
+
+def dataset_yaml_path(dataset_dir:str)->str:
+    """
+    Get the path of the yaml file of a dataset, it is named after the dataset directory.
+
+    :param dataset_dir: path to the dataset directory.
+    :return: path to the yaml file.
+    """
+    return os.path.join(dataset_dir, os.path.basename(os.path.normpath(dataset_dir)) + ".yaml")
+
+
+def write_dataset_yaml(dataset_dir:str, splits:dict, names:dict)->str:
+    """
+    Write the yaml file YOLO reads a dataset from.
+
+    :param dataset_dir: path to the dataset directory, the root of the image paths.
+    :param splits: image directory of every split relative to the dataset directory, e.g. {"train": "train/images"}.
+    :param names: dictionary containing the class names and their corresponding class ids.
+    :return: path to the yaml file.
+    """
+    yaml_path = dataset_yaml_path(dataset_dir)
+    with open(yaml_path, "w") as f:
+        # paths section
+        f.write("\n# Paths\n")
+        f.write(f"path: {dataset_dir}\n")
+        for split, image_dir in splits.items():
+            f.write(f"{split}: {image_dir}\n")
+
+        # classes section, the position of a name is its class id
+        f.write("\n# Classes\n")
+        f.write(f"nc: {len(names)}\n")
+        f.write(f"names: [{', '.join(sorted(names, key=names.get))}]")
+    return yaml_path
+
+
+def read_dataset_names(dataset_dir:str)->dict|None:
+    """
+    Read the class names from the yaml file of a dataset.
+
+    :param dataset_dir: path to the dataset directory.
+    :return: dictionary containing the class names and their corresponding class ids, None without a yaml file.
+    """
+    yaml_path = dataset_yaml_path(dataset_dir)
+    if not os.path.exists(yaml_path):
+        return None
+    with open(yaml_path) as f:
+        match = _NAMES.search(f.read())
+    if match is None:
+        raise ValueError(f"No names in {yaml_path}")
+    return {name.strip(): idx for idx, name in enumerate(match.group(1).split(","))}
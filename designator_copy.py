@@ -1,41 +1,101 @@
+import os
+
 import pandas as pd
-from tqdm import tqdm
 
-import os
+from spa_store import list_annotation_files, load_annotation_frame
+from process_pool import run_tasks
+from instrumentation import Profiler
 
 class DesignatorCopy:
     """
     Copy designator entries from base to target files.
     """
-    def __init__(self, base_file, target_dir, output_dir):
+    def __init__(self, base_file, target_dir, output_dir, join="position", key="Instance ID", strict=True, workers=1, profile=None):
+        """
+        :param base_file: annotation file to copy the designators from.
+        :param target_dir: directory with the target annotation files or an annotation store (see SpaStore).
+        :param output_dir: output directory.
+        :param join: "position" copies the designators row by row, "key" matches the rows by the key column.
+        :param key: column identifying a polygon in the "key" mode.
+        :param strict: fail target files whose rows don't match the base file instead of writing them.
+            Otherwise rows without a match get no designator.
+        :param workers: number of processes copying to target files in parallel.
+        :param profile: path of a JSON report with the time, files and bytes of every phase, None disables the instrumentation.
+        """
+        if join not in ("position", "key"):
+            raise ValueError(f"Unknown join mode: {join}")
+
         self.base_file = base_file
         self.target_dir = target_dir
         self.output_dir = output_dir
+        self.join = join
+        self.key = key
+        self.strict = strict
+        self.workers = workers
+        self.profiler = Profiler(profile)
+        self._designators = None
 
     def copy(self):
         """
         Copy designator entries from base to target files.
+        :return: dictionary of the written files with rows that had no match and their number (see _copy_file),
+            and a dictionary of the files that failed and their error messages.
         """
+        self.profiler.start()
+
         # create the output directories
         self._create_directories(self.output_dir)
-        
-        # for every file in the list
-        names = os.listdir(self.target_dir)
-        with tqdm(total=len(names)) as pbar:
-            for file_name in names:
-                
-                # read the file into a dataframe
-                df_base = pd.read_csv(self.base_file)
-                df_target = pd.read_csv(self.target_dir + "/" + file_name)
-                
-                # copy the designator column from the base file to the target file
-                df_target['Designator'] = df_base['Designator']
-                
-                # save the modified file
-                df_target.to_csv(self.output_dir + "/" + file_name, index=False)
-                
-                # update progress bar
-                pbar.update(1)
+
+        # read the base file once, only its designators are passed to the workers
+        with self.profiler.phase("read_base") as phase:
+            df_base = load_annotation_frame(self.base_file)
+            phase.read(self.base_file)
+        if self.join == "key":
+            duplicates = df_base[self.key].duplicated()
+            if duplicates.any():
+                raise ValueError(f"Duplicate {self.key} in base file: {list(df_base[self.key][duplicates].unique()[:5])}")
+            self._designators = pd.Series(df_base["Designator"].to_numpy(), index=df_base[self.key])
+        else:
+            self._designators = df_base["Designator"].reset_index(drop=True)
+
+        # copy the designators to every target file, spread across the workers
+        names = [os.path.basename(path) for path in list_annotation_files(self.target_dir)]
+        results, failures = run_tasks(self._copy_file, names, self.workers, self.profiler)
+        mismatches = {name: unmatched for name, unmatched in zip(names, results) if unmatched}
+        self.profiler.finish(files=len(names), failures=len(failures), mismatches=len(mismatches))
+        return mismatches, failures
+
+    def _copy_file(self, file_name):
+        """
+        Copy the designators of the base file to one target file.
+        :param file_name: name of the target file.
+        :return: number of rows without a match, in the "position" mode the difference of the row counts.
+        """
+        with self.profiler.phase("read") as phase:
+            df_target = load_annotation_frame(self.target_dir + "/" + file_name)
+            phase.read(self.target_dir + "/" + file_name)
+
+        # look up the designator of every target row
+        if self.join == "key":
+            designators = df_target[self.key].map(self._designators)
+            unmatched = int((~df_target[self.key].isin(self._designators.index)).sum())
+            if unmatched and self.strict:
+                raise ValueError(f"{unmatched} rows with a {self.key} missing in the base file")
+        else:
+            designators = self._designators.reindex(range(len(df_target)))
+            # a shorter target leaves base designators unused, a longer one has rows without a designator
+            unmatched = abs(len(df_target) - len(self._designators))
+            if len(df_target) != len(self._designators) and self.strict:
+                raise ValueError(f"{len(df_target)} rows, but the base file has {len(self._designators)}")
+
+        # copy the designator column from the base file to the target file
+        df_target["Designator"] = designators.to_numpy()
+
+        # save the modified file
+        with self.profiler.phase("write") as phase:
+            df_target.to_csv(self.output_dir + "/" + file_name, index=False)
+            phase.wrote(self.output_dir + "/" + file_name)
+        return unmatched
 
     def _create_directories(self, output_dir):
         """
@@ -43,4 +103,4 @@ class DesignatorCopy:
         :param output_dir: output directory.
         """
         if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
\ No newline at end of file
+            os.makedirs(output_dir)
@@ -1,42 +1,93 @@
-from tqdm import tqdm
-import pandas as pd
+from collections import Counter
 
 import os
 
+from spa_store import list_annotation_files, load_annotation_frame
+from process_pool import run_tasks
+from instrumentation import Profiler
+
 class DesignatorReplace:
     """
     Replace designators specified in the replace_dict in the input_dir and save the modified files in the output_dir.
     """
-    def __init__(self, input_dir, output_dir, replace_dict):
+    def __init__(self, input_dir, output_dir, replace_dict, workers=1, profile=None):
+        """
+        :param input_dir: directory with the annotation files or an annotation store (see SpaStore).
+        :param output_dir: output directory.
+        :param replace_dict: dictionary of the new designators and the lists of designators they replace.
+            A designator listed under several keys is replaced by the first one.
+        :param workers: number of processes replacing files in parallel.
+        :param profile: path of a JSON report with the time, files and bytes of every phase, None disables the instrumentation.
+        """
         self.input_dir = input_dir
         self.output_dir = output_dir
         self.replace_dict = replace_dict
+        self.workers = workers
+        self.profiler = Profiler(profile)
+
+        # invert the dictionary once, every old designator points to its new one
+        self._mapping = {}
+        for key, value in replace_dict.items():
+            for item in value:
+                if item != key:
+                    self._mapping.setdefault(item, key)
 
     def replace(self):
         """
         Replace designators specified in the replace_dict in the input_dir and save the modified files in the output_dir.
+        :return: dictionary of the new designators and how many entries were replaced by them,
+            and a dictionary of the files that failed and their error messages.
         """
+        self.profiler.start()
+
         # create the output directories
         self._create_directories(self.output_dir)
-        
-        # for every file in the list
-        names = os.listdir(self.input_dir)
-        with tqdm(total=len(names)) as pbar:
-            for file_name in names:
-                
-                # read the file into a dataframe
-                df = pd.read_csv(self.input_dir + "/" + file_name)
-                
-                # replace the specified designators with the corresponding keys
-                for key, value in self.replace_dict.items():
-                    for item in value:
-                        df = df.replace(item, key)
-                
-                # save the modified file
-                df.to_csv(self.output_dir + "/" + file_name, index=False)
-                
-                # update progress bar
-                pbar.update(1)
+
+        # replace the designators of every file, spread across the workers
+        names = [os.path.basename(path) for path in list_annotation_files(self.input_dir)]
+        results, failures = run_tasks(self._replace_file, names, self.workers, self.profiler)
+
+        # sum up the replacements of all files
+        replacements = Counter()
+        for counts in results:
+            if counts is not None:
+                replacements.update(counts)
+        self.profiler.finish(files=len(names), failures=len(failures), replacements=dict(replacements))
+        return dict(replacements), failures
+
+    def _replace_file(self, file_name):
+        """
+        Replace the designators of one file.
+        :param file_name: name of the annotation file.
+        :return: dictionary of the new designators and how many entries were replaced by them.
+        """
+        # read the file into a dataframe
+        with self.profiler.phase("read") as phase:
+            df = load_annotation_frame(self.input_dir + "/" + file_name)
+            phase.read(self.input_dir + "/" + file_name)
+
+        # replace the specified designators with the corresponding keys
+        with self.profiler.phase("replace"):
+            counts = self.replace_frame(df)
+
+        # save the modified file
+        with self.profiler.phase("write") as phase:
+            df.to_csv(self.output_dir + "/" + file_name, index=False)
+            phase.wrote(self.output_dir + "/" + file_name)
+        return counts
+
+    def replace_frame(self, df):
+        """
+        Replace the designators of a dataframe in place.
+        :param df: pandas dataframe with a Designator column.
+        :return: dictionary of the new designators and how many entries were replaced by them.
+        """
+        # look up all designators at once, only the designator column is touched
+        designators = df["Designator"]
+        mapped = designators.map(self._mapping)
+        replaced = mapped.notna()
+        df["Designator"] = mapped.where(replaced, designators)
+        return mapped[replaced].value_counts().to_dict()
 
     def _create_directories(self, output_dir):
         """
@@ -0,0 +1,73 @@
+import os
+import shutil
+import errno
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, reflinks fall back to copies there
+    fcntl = None
+
+LINK_MODES = ("copy", "hardlink", "symlink", "reflink")
+
+# ioctl request to share the extents of one file with another (Linux, e.g. btrfs and xfs)
+_FICLONE = 0x40049409
+
+
+def link_file(src:str, dst:str, link_mode:str="copy")->str:
+    """
+    Materialize a file at a new location.
+    Links that can't be created, e.g. because source and destination are on different
+    filesystems or the filesystem doesn't support them, fall back to a copy.
+
+    :param src: path to the source file.
+    :param dst: path to the destination file, an existing file is replaced.
+    :param link_mode: "copy", "hardlink", "symlink" or "reflink".
+    :return: path to the destination file.
+    """
+    if link_mode not in LINK_MODES:
+        raise ValueError(f"Unknown link mode: {link_mode}")
+
+    # never write through an existing link into its source
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    try:
+        if link_mode == "hardlink":
+            os.link(src, dst)
+            return dst
+        if link_mode == "symlink":
+            os.symlink(os.path.abspath(src), dst)
+            return dst
+        if link_mode == "reflink" and _reflink(src, dst):
+            return dst
+    except OSError:
+        if os.path.lexists(dst):
+            os.remove(dst)
+
+    shutil.copy(src, dst)
+    return dst
+
+
+def _reflink(src:str, dst:str)->bool:
+    """
+    Create a copy-on-write clone of a file.
+
+    :param src: path to the source file.
+    :param dst: path to the destination file, must not exist.
+    :return: True if the clone was created, False if reflinks aren't supported.
+    """
+    if fcntl is None:
+        return False
+
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+        except OSError as e:
+            if e.errno in (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EBADF):
+                fdst.close()
+                os.remove(dst)
+                return False
+            raise
+    shutil.copymode(src, dst)
+    return True
@@ -2,53 +2,263 @@ import cv2
 from tqdm import tqdm
 
 import os
+import queue
+import threading
+
+from build_manifest import BuildManifest
+from process_pool import report_failure
+from instrumentation import Profiler
+
+class HsiClaheTransform:
+    """
+    Convert an image from BGR to HSI and apply CLAHE to the intensity channel.
+    Can be passed as transform to the SpaPatchCreator.
+    """
+    def __init__(self, precision, tile_grid_size=(8, 8)):
+        """
+        :param precision: precision of the CLAHE.
+        :param tile_grid_size: number of CLAHE tiles in x and y direction.
+        """
+        self.precision = precision
+        self.tile_grid_size = tuple(tile_grid_size)
+        self._clahe = None
+
+    def __call__(self, img):
+        """
+        Apply the transform. An instance must not be shared between threads.
+        :param img: BGR image.
+        :return: converted image.
+        """
+        # the CLAHE instance is created once and reused
+        if self._clahe is None:
+            self._clahe = cv2.createCLAHE(clipLimit=self.precision, tileGridSize=self.tile_grid_size)
+
+        # convert the image from BGR to HSI
+        img1 = cv2.cvtColor(img, cv2.COLOR_BGR2HLS)
+
+        # apply CLAHE to the intensity channel
+        img1[:, :, 1] = self._clahe.apply(img1[:, :, 1])
+        return img1
+
+    def __getstate__(self):
+        # OpenCV objects can't be pickled, worker processes create their own
+        state = self.__dict__.copy()
+        state["_clahe"] = None
+        return state
+
+    def __repr__(self):
+        return f"HsiClaheTransform(precision={self.precision}, tile_grid_size={self.tile_grid_size})"
+
 
 class HsiClaheConverter:
     """
     Convert images from BGR to HSI and apply CLAHE.
     """
-    def __init__(self, img_dir, output_dir, precision):
+    def __init__(self, img_dir, output_dir, precision, incremental=False, tile_grid_size=(8, 8), output_format=None, compression=None, workers=1, profile=None):
         """
         Initialize the HSI_CLAHE_Converter class.
         :param img_dir: directory containing the images.
         :param output_dir: output directory.
         :param precision: precision of the CLAHE.
+        :param incremental: skip images that are unchanged since the last run
+            and delete the outputs of images that disappeared.
+        :param tile_grid_size: number of CLAHE tiles in x and y direction.
+        :param output_format: file extension of the output images, e.g. "png" or "jpg". None keeps the input format.
+        :param compression: PNG compression level (0-9), JPEG or WEBP quality (0-100). None uses the OpenCV default.
+        :param workers: number of threads. With more than one thread decoding, conversion and encoding
+            of different images overlap, connected by a bounded queue.
+        :param profile: path of a JSON report with the time, files and bytes of every phase, None disables the instrumentation.
         """
         self.image_dir = img_dir
         self.output_dir = output_dir
         self.precision = precision
+        self.incremental = incremental
+        self.tile_grid_size = tuple(tile_grid_size)
+        self.output_format = output_format
+        self.compression = compression
+        self.workers = workers
+        self.profiler = Profiler(profile)
+        self._local = threading.local()
 
     def convert(self):
         """
         Convert images from BGR to HSI and apply CLAHE.
+        :return: dictionary of the images that failed and their error messages.
         """
+        self.profiler.start()
+
         # create the output directories
         self._create_directories(self.output_dir)
-        
-        # for every image in the list
-        names = os.listdir(self.image_dir)
+
+        # for every image in the list, hidden files like the build manifest are skipped
+        names = sorted(name for name in os.listdir(self.image_dir) if not name.startswith("."))
+
+        # on incremental runs only new or changed images are converted
+        if self.incremental:
+            params = {"image_dir": self.image_dir, "precision": self.precision, "tile_grid_size": self.tile_grid_size,
+                      "output_format": self.output_format, "compression": self.compression}
+            manifest = BuildManifest(self.output_dir, params)
+            pending = set(manifest.pending([self.image_dir + "/" + name for name in names]))
+            names = [name for name in names if self.image_dir + "/" + name in pending]
+
         with tqdm(total=len(names)) as pbar:
-            for image_name in names:
-                
-                # read the image
-                img = cv2.imread(self.image_dir + "/" + image_name)
-                
-                # convert the image from BGR to HSI
-                img1 = cv2.cvtColor(img, cv2.COLOR_BGR2HLS)
-                
-                # apply CLAHE to the intensity channel
-                img1[:, :, 1] = cv2.createCLAHE(clipLimit=self.precision, tileGridSize=(8, 8)).apply(img1[:, :, 1])
-                
-                # save the image
-                cv2.imwrite(self.output_dir + "/" + image_name, img1)
-                
-                # update progress bar
-                pbar.update(1)
-    
+            if self.workers > 1:
+                results, failures = self._convert_pipelined(names, pbar)
+            else:
+                results, failures = [], {}
+                for image_name in names:
+
+                    # convert the image
+                    try:
+                        results.append(self._convert_image(image_name))
+                    except Exception as e:
+                        results.append(None)
+                        report_failure(failures, image_name, e)
+
+                    # update progress bar
+                    pbar.update(1)
+
+        if self.incremental:
+            manifest.update([self.image_dir + "/" + name for name in names], results)
+        self.profiler.finish(files=len(names), failures=len(failures))
+        return failures
+
+    def _convert_pipelined(self, names, pbar):
+        """
+        Convert the images with decoder and converter threads connected by a bounded queue.
+        :param names: names of the image files.
+        :param pbar: progress bar.
+        :return: results per image (None for failed images) and a dictionary of failures.
+        """
+        results = [None] * len(names)
+        failures = {}
+        lock = threading.Lock()
+
+        # decoded images wait in a bounded queue, so at most a few frames per thread are held in memory
+        pending = queue.Queue()
+        for idx in range(len(names)):
+            pending.put(idx)
+        decoded = queue.Queue(maxsize=2 * self.workers)
+
+        def decode():
+            while True:
+                try:
+                    idx = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    decoded.put((idx, self._read_image(names[idx])))
+                except Exception as e:
+                    decoded.put((idx, e))
+
+        def convert():
+            while True:
+                item = decoded.get()
+                if item is None:
+                    return
+                idx, img = item
+                try:
+                    if isinstance(img, Exception):
+                        raise img
+                    result = self._write_image(names[idx], self._apply_clahe(img))
+                except Exception as e:
+                    with lock:
+                        report_failure(failures, names[idx], e)
+                else:
+                    results[idx] = result
+                with lock:
+                    pbar.update(1)
+
+        decoders = [threading.Thread(target=decode) for _ in range(self.workers)]
+        converters = [threading.Thread(target=convert) for _ in range(self.workers)]
+        for thread in decoders + converters:
+            thread.start()
+        for thread in decoders:
+            thread.join()
+
+        # stop the converters once all decoded images are taken
+        for _ in converters:
+            decoded.put(None)
+        for thread in converters:
+            thread.join()
+        return results, failures
+
+    def _convert_image(self, image_name):
+        """
+        Convert one image from BGR to HSI and apply CLAHE.
+        :param image_name: name of the image file.
+        :return: paths of the input and the output image.
+        """
+        return self._write_image(image_name, self._apply_clahe(self._read_image(image_name)))
+
+    def _read_image(self, image_name):
+        """
+        Read an image.
+        :param image_name: name of the image file.
+        :return: the decoded image.
+        """
+        with self.profiler.phase("decode") as phase:
+            img = cv2.imread(self.image_dir + "/" + image_name)
+            if img is None:
+                raise ValueError(f"Could not read image: {self.image_dir}/{image_name}")
+            phase.read(self.image_dir + "/" + image_name)
+        return img
+
+    def _apply_clahe(self, img):
+        """
+        Convert an image from BGR to HSI and apply CLAHE to the intensity channel.
+        :param img: BGR image.
+        :return: converted image.
+        """
+        # every thread reuses its own transform and with it its CLAHE instance
+        transform = getattr(self._local, "transform", None)
+        if transform is None:
+            transform = HsiClaheTransform(self.precision, self.tile_grid_size)
+            self._local.transform = transform
+        with self.profiler.phase("clahe"):
+            return transform(img)
+
+    def _write_image(self, image_name, img):
+        """
+        Encode and save a converted image.
+        :param image_name: name of the input image file.
+        :param img: converted image.
+        :return: paths of the input and the output image.
+        """
+        # exchange the file extension if an output format is given
+        output_name = image_name
+        if self.output_format is not None:
+            output_name = os.path.splitext(image_name)[0] + "." + self.output_format.lstrip(".")
+        output_path = self.output_dir + "/" + output_name
+
+        # save the image
+        with self.profiler.phase("encode") as phase:
+            if not cv2.imwrite(output_path, img, self._write_params(output_name)):
+                raise ValueError(f"Could not write image: {output_path}")
+            phase.wrote(output_path)
+        return [self.image_dir + "/" + image_name], [output_path]
+
+    def _write_params(self, output_name):
+        """
+        Get the encoder parameters for the compression setting.
+        :param output_name: name of the output file.
+        :return: list of OpenCV imwrite parameters.
+        """
+        if self.compression is None:
+            return []
+        ext = os.path.splitext(output_name)[1].lower()
+        if ext == ".png":
+            return [cv2.IMWRITE_PNG_COMPRESSION, int(self.compression)]
+        if ext in (".jpg", ".jpeg"):
+            return [cv2.IMWRITE_JPEG_QUALITY, int(self.compression)]
+        if ext == ".webp":
+            return [cv2.IMWRITE_WEBP_QUALITY, int(self.compression)]
+        return []
+
     def _create_directories(self, output_dir):
         """
         Create the output directories.
         :param output_dir: output directory.
         """
         if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
\ No newline at end of file
+            os.makedirs(output_dir)
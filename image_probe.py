@@ -0,0 +1,162 @@
+import io
+import os
+import struct
+from functools import lru_cache
+
+import cv2
+
+
+def probe_image_size(image_path:str)->tuple[int, int]:
+    """
+    Read the width and height of an image from its file header without decoding the pixels.
+    PNG, JPEG, TIFF and BMP headers are understood, other formats are decoded completely.
+    Results are cached per file as long as its size and modification time don't change.
+
+    :param image_path: path to the image file.
+    :return: width and height of the image.
+    """
+    stat = os.stat(image_path)
+    return _probe(image_path, stat.st_mtime_ns, stat.st_size)
+
+
+@lru_cache(maxsize=65536)
+def _probe(image_path:str, mtime_ns:int, file_size:int)->tuple[int, int]:
+    """
+    Probe the image size, the modification time and file size are part of the cache key.
+
+    :param image_path: path to the image file.
+    :param mtime_ns: modification time of the file in nanoseconds.
+    :param file_size: size of the file in bytes.
+    :return: width and height of the image.
+    """
+    with open(image_path, "rb") as f:
+        head = f.read(32)
+        f.seek(0)
+        try:
+            if head.startswith(b"\x89PNG\r\n\x1a\n"):
+                size = _png_size(head)
+            elif head.startswith(b"\xff\xd8"):
+                size = _jpeg_size(f)
+            elif head[:4] in (b"II*\x00", b"MM\x00*"):
+                size = _tiff_size(f)
+            elif head.startswith(b"BM"):
+                size = _bmp_size(head)
+            else:
+                size = None
+        except struct.error:
+            # truncated or malformed header
+            size = None
+
+    if size is None:
+        # fall back to decoding the image
+        image = cv2.imread(image_path)
+        if image is None:
+            raise ValueError(f"Could not read image: {image_path}")
+        height, width = image.shape[:2]
+        size = width, height
+    return size
+
+
+def _png_size(head:bytes)->tuple[int, int]:
+    """
+    Read the size from the IHDR chunk of a PNG file.
+
+    :param head: first bytes of the file.
+    :return: width and height of the image.
+    """
+    width, height = struct.unpack(">II", head[16:24])
+    return width, height
+
+
+def _jpeg_size(f)->tuple[int, int]|None:
+    """
+    Read the size from the start of frame segment of a JPEG file.
+    The size is swapped if the EXIF orientation rotates the image by 90 degrees, like cv2.imread does.
+
+    :param f: binary file object positioned at the start of the file.
+    :return: width and height of the image, None if no frame header was found.
+    """
+    f.read(2)
+    transposed = False
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        # skip fill bytes
+        while marker[1] == 0xFF:
+            marker = marker[1:] + f.read(1)
+        code = marker[1]
+
+        # standalone markers have no length field
+        if code == 0x01 or 0xD0 <= code <= 0xD7:
+            continue
+        length = struct.unpack(">H", f.read(2))[0]
+        segment = f.read(length - 2)
+
+        if code == 0xE1 and segment.startswith(b"Exif\x00\x00"):
+            tags = _read_ifd(io.BytesIO(segment[6:]), (0x0112,))
+            transposed = tags.get(0x0112, 1) in (5, 6, 7, 8)
+        elif 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack(">HH", segment[1:5])
+            return (height, width) if transposed else (width, height)
+        elif code == 0xDA:
+            return None
+
+
+def _tiff_size(f)->tuple[int, int]|None:
+    """
+    Read the size from the first image file directory of a TIFF file.
+
+    :param f: binary file object positioned at the start of the file.
+    :return: width and height of the image, None if the tags are missing or the image is rotated.
+    """
+    tags = _read_ifd(f, (0x0100, 0x0101, 0x0112))
+    if 0x0100 not in tags or 0x0101 not in tags or tags.get(0x0112, 1) != 1:
+        return None
+    return tags[0x0100], tags[0x0101]
+
+
+def _bmp_size(head:bytes)->tuple[int, int]:
+    """
+    Read the size from the DIB header of a BMP file.
+
+    :param head: first bytes of the file.
+    :return: width and height of the image.
+    """
+    header_size = struct.unpack("<I", head[14:18])[0]
+    if header_size == 12:
+        width, height = struct.unpack("<HH", head[18:22])
+    else:
+        # bottom-up bitmaps have a positive height, top-down bitmaps a negative one
+        width, height = struct.unpack("<ii", head[18:26])
+    return abs(width), abs(height)
+
+
+def _read_ifd(f, wanted:tuple)->dict:
+    """
+    Read integer tags from the first image file directory of a TIFF structure.
+
+    :param f: binary file object positioned at the TIFF header.
+    :param wanted: tag numbers to read.
+    :return: dictionary of the found tags and their values.
+    """
+    base = f.tell()
+    header = f.read(8)
+    endian = "<" if header[:2] == b"II" else ">"
+    offset = struct.unpack(endian + "I", header[4:8])[0]
+
+    f.seek(base + offset)
+    count = struct.unpack(endian + "H", f.read(2))[0]
+    entries = f.read(count * 12)
+
+    tags = {}
+    for entry in range(count):
+        tag, kind = struct.unpack(endian + "HH", entries[entry * 12:entry * 12 + 4])
+        if tag not in wanted:
+            continue
+        # SHORT values are stored left aligned in the value field
+        if kind == 3:
+            tags[tag] = struct.unpack(endian + "H", entries[entry * 12 + 8:entry * 12 + 10])[0]
+        elif kind == 4:
+            tags[tag] = struct.unpack(endian + "I", entries[entry * 12 + 8:entry * 12 + 12])[0]
+    return tags
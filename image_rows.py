@@ -0,0 +1,127 @@
+import os
+import struct
+import hashlib
+from glob import glob, escape
+
+import numpy as np
+import cv2
+
+
+class ImageRows:
+    """
+    Pixels of an uncompressed image file, read band by band. Every read memory maps only the requested
+    rows and copies them out, so the memory is bounded by the band instead of the whole image.
+    """
+
+    def __init__(self, path:str, offset:int, width:int, height:int, pixel_bytes:int, row_bytes:int, bottom_up:bool=False):
+        """
+        :param path: path to the file.
+        :param offset: position of the first pixel row in the file.
+        :param width: width of the image.
+        :param height: height of the image.
+        :param pixel_bytes: bytes per pixel, the first three are blue, green and red.
+        :param row_bytes: bytes per row including padding.
+        :param bottom_up: the rows are stored from the bottom to the top of the image.
+        """
+        self.path = path
+        self.offset = offset
+        self.width = width
+        self.height = height
+        self.pixel_bytes = pixel_bytes
+        self.row_bytes = row_bytes
+        self.bottom_up = bottom_up
+
+    def read(self, y_min:int, y_max:int)->np.ndarray:
+        """
+        Read a band of rows.
+
+        :param y_min: first row.
+        :param y_max: row after the last row, clipped to the image height.
+        :return: (y_max - y_min, W, 3) BGR array like cv2.imread returns.
+        """
+        y_max = min(y_max, self.height)
+        start = self.height - y_max if self.bottom_up else y_min
+        rows = np.memmap(self.path, dtype=np.uint8, mode="r", offset=self.offset + start * self.row_bytes,
+                         shape=(y_max - y_min, self.row_bytes))
+        band = rows[:, :self.width * self.pixel_bytes].reshape(y_max - y_min, self.width, self.pixel_bytes)[:, :, :3]
+        return np.ascontiguousarray(band[::-1] if self.bottom_up else band)
+
+
+def open_image_rows(image_path:str, cache_dir:str=None)->ImageRows|None:
+    """
+    Open an image for reading bands of rows without decoding it completely. Uncompressed BMP files and
+    .npy arrays are read directly. Other formats are decoded once into a .npy file in the cache directory,
+    which is read on later calls as long as the image keeps its path, size and modification time.
+
+    :param image_path: path to the image file.
+    :param cache_dir: directory of the decoded images, None if compressed formats should not be cached.
+    :return: rows of the image, None if the image has to be decoded completely.
+    """
+    if image_path.endswith(".npy"):
+        return _npy_rows(image_path)
+    rows = _bmp_rows(image_path)
+    if rows is not None or cache_dir is None:
+        return rows
+
+    # images of the same name in different directories get different cache files,
+    # a changed image gets a new cache file and the outdated ones are deleted
+    stat = os.stat(image_path)
+    source = hashlib.blake2b(os.path.abspath(image_path).encode(), digest_size=8).hexdigest()
+    version = hashlib.blake2b(f"{stat.st_size}:{stat.st_mtime_ns}".encode(), digest_size=8).hexdigest()
+    prefix = os.path.join(cache_dir, f"{os.path.basename(image_path)}.{source}")
+    cache_path = f"{prefix}.{version}.npy"
+    if not os.path.exists(cache_path):
+        image = cv2.imread(image_path)
+        if image is None:
+            raise ValueError(f"Could not read image: {image_path}")
+        for outdated in glob(escape(prefix) + ".*.npy"):
+            os.remove(outdated)
+
+        # write next to the cache first, so concurrent readers never see a partial file
+        os.makedirs(cache_dir, exist_ok=True)
+        temp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            np.save(f, image)
+        os.replace(temp_path, cache_path)
+    return _npy_rows(cache_path)
+
+
+def _npy_rows(path:str)->ImageRows:
+    """
+    Open the rows of a (H, W, 3) uint8 array in a .npy file.
+
+    :param path: path to the file.
+    :return: rows of the image.
+    """
+    with open(path, "rb") as f:
+        version = np.lib.format.read_magic(f)
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+        shape, fortran_order, dtype = read_header(f)
+        offset = f.tell()
+    if dtype != np.uint8 or fortran_order or len(shape) != 3 or shape[2] != 3:
+        raise ValueError(f"Expected a (H, W, 3) uint8 array in C order: {path}")
+    height, width = shape[:2]
+    return ImageRows(path, offset, width, height, 3, width * 3)
+
+
+def _bmp_rows(path:str)->ImageRows|None:
+    """
+    Open the rows of an uncompressed 24 or 32 bit BMP file.
+
+    :param path: path to the file.
+    :return: rows of the image, None for other files.
+    """
+    with open(path, "rb") as f:
+        head = f.read(34)
+    if len(head) < 34 or not head.startswith(b"BM"):
+        return None
+    offset, header_size = struct.unpack("<II", head[10:18])
+    if header_size < 40:
+        return None
+    width, height, _, bits, compression = struct.unpack("<iiHHI", head[18:34])
+    if bits not in (24, 32) or compression != 0:
+        return None
+
+    # rows are padded to a multiple of 4 bytes, bottom-up bitmaps have a positive height
+    row_bytes = (width * bits + 31) // 32 * 4
+    return ImageRows(path, offset, width, abs(height), bits // 8, row_bytes, bottom_up=height > 0)
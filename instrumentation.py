@@ -0,0 +1,232 @@
+import os
+import sys
+import json
+import time
+import threading
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, the peak working set of psutil is used there
+    resource = None
+import psutil
+
+
+def peak_rss_mb(children:bool=False)->float:
+    """
+    Get the peak resident memory of the current process.
+
+    :param children: also take the terminated child processes into account, e.g. the workers of a joined
+        process pool. The result is the peak of the largest single process, not the sum. Windows doesn't
+        keep the memory of terminated processes, only the current process is measured there.
+    :return: peak memory in MiB.
+    """
+    if resource is not None:
+        # ru_maxrss is in KiB on Linux and in bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if children:
+            peak = max(peak, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+    return psutil.Process().memory_info().peak_wset / 2**20
+
+
+class Profiler:
+    """
+    Opt-in instrumentation of a run. Records per phase the wall time, the files and bytes read
+    and written, and writes a JSON report at the end of the run. A disabled profiler hands out
+    a shared phase that does nothing, so the instrumented code costs a method call per phase.
+    """
+
+    def __init__(self, report_path:str=None):
+        """
+        :param report_path: path of the JSON report, None disables the profiler.
+        """
+        self.report_path = report_path
+        self.enabled = report_path is not None
+        self._phases = {}
+        self._peak_rss_mb = 0.0
+        self._started = None
+        self._lock = threading.Lock()
+
+    def phase(self, name:str)->"_Phase":
+        """
+        Measure a phase, to be used as context manager. Phases of the same name are summed up,
+        also across threads, so their time is the busy time of all threads together.
+
+        :param name: name of the phase.
+        :return: the phase, its read and wrote methods record the files it touched.
+        """
+        if not self.enabled:
+            return _NULL_PHASE
+        return _Phase(self, name)
+
+    def start(self)->None:
+        """
+        Start a run and forget the measurements of earlier runs.
+        """
+        self.reset()
+        self._started = time.perf_counter()
+
+    def finish(self, **extra)->dict|None:
+        """
+        Finish a run and write the report.
+
+        :param extra: further values to include in the report, e.g. the number of failures.
+        :return: the report, None if the profiler is disabled.
+        """
+        if not self.enabled:
+            return None
+        elapsed = time.perf_counter() - self._started
+        snapshot = self.snapshot()
+
+        phases = {}
+        for name, stats in snapshot["phases"].items():
+            files = stats["files_read"] + stats["files_written"]
+            phases[name] = dict(stats, files_per_s=files / stats["seconds"] if stats["seconds"] > 0 else 0.0)
+        files_written = sum(stats["files_written"] for stats in phases.values())
+        report = {
+            "seconds": elapsed,
+            "bytes_read": sum(stats["bytes_read"] for stats in phases.values()),
+            "bytes_written": sum(stats["bytes_written"] for stats in phases.values()),
+            "files_written": files_written,
+            "files_per_s": files_written / elapsed if elapsed > 0 else 0.0,
+            "peak_rss_mb": snapshot["peak_rss_mb"],
+            "phases": phases,
+            **extra,
+        }
+
+        # write next to the report first, so an interrupted write leaves no broken report
+        os.makedirs(os.path.dirname(os.path.abspath(self.report_path)), exist_ok=True)
+        temp_path = self.report_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(report, f, indent=2)
+        os.replace(temp_path, self.report_path)
+        return report
+
+    def reset(self)->None:
+        """
+        Forget all measurements.
+        """
+        with self._lock:
+            self._phases = {}
+            self._peak_rss_mb = 0.0
+
+    def snapshot(self)->dict:
+        """
+        Get the measurements so far, including the peak memory of the current process.
+
+        :return: dictionary of the phase statistics and the peak memory.
+        """
+        with self._lock:
+            self._peak_rss_mb = max(self._peak_rss_mb, peak_rss_mb())
+            return {"phases": {name: dict(stats) for name, stats in self._phases.items()}, "peak_rss_mb": self._peak_rss_mb}
+
+    def merge(self, snapshot:dict)->None:
+        """
+        Add the measurements of another process, e.g. a worker of a process pool.
+
+        :param snapshot: measurements as returned by snapshot.
+        """
+        with self._lock:
+            for name, stats in snapshot["phases"].items():
+                totals = self._phases.setdefault(name, _empty_stats())
+                for key, value in stats.items():
+                    totals[key] += value
+            self._peak_rss_mb = max(self._peak_rss_mb, snapshot["peak_rss_mb"])
+
+    def _add(self, name:str, seconds:float, files_read:int, bytes_read:int, files_written:int, bytes_written:int)->None:
+        """
+        Add the measurements of one pass through a phase.
+        """
+        with self._lock:
+            stats = self._phases.setdefault(name, _empty_stats())
+            stats["calls"] += 1
+            stats["seconds"] += seconds
+            stats["files_read"] += files_read
+            stats["bytes_read"] += bytes_read
+            stats["files_written"] += files_written
+            stats["bytes_written"] += bytes_written
+
+    def __getstate__(self):
+        # locks can't be pickled, worker processes create their own
+        state = self.__dict__.copy()
+        state["_lock"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+class _Phase:
+    """
+    One pass through a phase of an enabled profiler.
+    """
+
+    def __init__(self, profiler:Profiler, name:str):
+        self.profiler = profiler
+        self.name = name
+        self.files_read = 0
+        self.bytes_read = 0
+        self.files_written = 0
+        self.bytes_written = 0
+
+    def read(self, path:str)->None:
+        """
+        Record a file read in this phase. Paths that are no files, like the annotation files
+        of a store, count as a file without bytes.
+
+        :param path: path to the file.
+        """
+        self.files_read += 1
+        if os.path.isfile(path):
+            self.bytes_read += os.path.getsize(path)
+
+    def wrote(self, path:str, size:int=None)->None:
+        """
+        Record a file written in this phase.
+
+        :param path: path to the file.
+        :param size: number of bytes written, for data appended to a file that isn't complete yet.
+        """
+        self.files_written += 1
+        self.bytes_written += os.path.getsize(path) if size is None else size
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler._add(self.name, time.perf_counter() - self._start, self.files_read, self.bytes_read,
+                           self.files_written, self.bytes_written)
+        return False
+
+
+class _NullPhase:
+    """
+    Phase of a disabled profiler, records nothing.
+    """
+
+    def read(self, path:str)->None:
+        pass
+
+    def wrote(self, path:str, size:int=None)->None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+def _empty_stats()->dict:
+    """
+    Get the statistics of a phase without measurements.
+
+    :return: dictionary of zero counters.
+    """
+    return {"calls": 0, "seconds": 0.0, "files_read": 0, "bytes_read": 0, "files_written": 0, "bytes_written": 0}
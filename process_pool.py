@@ -0,0 +1,91 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from tqdm import tqdm
+
+
+def run_tasks(func, items:list, workers:int=1, profiler=None, consume=None, fail_fast:bool=False)->tuple[list, dict]:
+    """
+    Call func for every item and report the progress. With more than one worker the items are
+    spread across a process pool. A failing item is reported and doesn't abort the other items.
+
+    :param func: picklable callable taking one item.
+    :param items: list of items to process.
+    :param workers: number of worker processes, 1 runs in the current process.
+    :param profiler: profiler func records to (see Profiler). The measurements of worker processes are merged into it.
+    :param consume: callable applied in the current process to every result as soon as it arrives,
+        its return value is kept as the result. E.g. to stream the outputs of all workers into one file.
+    :param fail_fast: raise the error of the first failing item and cancel the items that haven't started yet.
+    :return: results in the order of the items (None for failed items) and a dictionary of failed items and their error messages.
+    """
+    results = [None] * len(items)
+    failures = {}
+    profiled = workers > 1 and profiler is not None and profiler.enabled
+    if profiled:
+        func = _ProfiledTask(func, profiler)
+
+    with tqdm(total=len(items)) as pbar:
+        if workers <= 1:
+            for idx, item in enumerate(items):
+                try:
+                    results[idx] = func(item)
+                    if consume is not None:
+                        results[idx] = consume(results[idx])
+                except Exception as e:
+                    if fail_fast:
+                        raise
+                    results[idx] = None
+                    report_failure(failures, item, e)
+                pbar.update(1)
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(func, item): idx for idx, item in enumerate(items)}
+                for future in as_completed(futures):
+                    idx = futures[future]
+                    try:
+                        results[idx] = future.result()
+                        if profiled:
+                            results[idx], snapshot = results[idx]
+                            profiler.merge(snapshot)
+                        if consume is not None:
+                            results[idx] = consume(results[idx])
+                    except Exception as e:
+                        if fail_fast:
+                            executor.shutdown(wait=False, cancel_futures=True)
+                            raise
+                        results[idx] = None
+                        report_failure(failures, items[idx], e)
+                    pbar.update(1)
+
+    return results, failures
+
+
+def report_failure(failures:dict, item, error:Exception)->None:
+    """
+    Record a failed item and print it without breaking the progress bar.
+
+    :param failures: dictionary of failed items and their error messages.
+    :param item: the failed item.
+    :param error: the raised exception.
+    """
+    failures[item] = f"{type(error).__name__}: {error}"
+    tqdm.write(f"Failed {item}: {failures[item]}")
+
+
+class _ProfiledTask:
+    """
+    Task of a worker process that returns the measurements of its profiler along with the result.
+    """
+
+    def __init__(self, func, profiler):
+        """
+        :param func: picklable callable taking one item, recording to the profiler.
+        :param profiler: the profiler, pickled together with func so the worker records to its copy.
+        """
+        self.func = func
+        self.profiler = profiler
+
+    def __call__(self, item):
+        # every task starts with the measurements of the parent process, only its own are sent back
+        self.profiler.reset()
+        result = self.func(item)
+        return result, self.profiler.snapshot()
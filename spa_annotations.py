@@ -0,0 +1,174 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from spa_vertices import parse_vertices
+
+
+class SpaAnnotations:
+    """
+    Parsed S3A annotation file with all polygons packed into flat NumPy buffers.
+    Every ring of a row is a polygon of its own, so a row can own several consecutive polygons.
+    """
+
+    def __init__(self, frame:pd.DataFrame, vertices:np.ndarray, offsets:np.ndarray, rows:np.ndarray, errors:dict=None):
+        """
+        :param frame: pandas dataframe containing the annotation rows.
+        :param vertices: (N, 2) array with the x and y coordinates of all polygons back to back.
+        :param offsets: (P + 1,) array, polygon p owns vertices[offsets[p]:offsets[p + 1]].
+        :param rows: (P,) ascending array with the dataframe row of every polygon.
+        :param errors: dictionary of the rows whose vertices couldn't be parsed and their error messages.
+        """
+        self.frame = frame
+        self.vertices = vertices
+        self.offsets = offsets
+        self.rows = rows
+        self.errors = errors if errors is not None else {}
+        self.bboxes = self._compute_bboxes()
+
+    @classmethod
+    def from_csv(cls, ann_file:str, strict:bool=False)->"SpaAnnotations":
+        """
+        Read and parse an S3A annotation file.
+
+        :param ann_file: path to the annotation csv file.
+        :param strict: raise on rows whose vertices can't be parsed instead of skipping them.
+        :return: parsed annotations.
+        """
+        return cls.from_frame(pd.read_csv(ann_file), strict, ann_file)
+
+    @classmethod
+    def from_frame(cls, frame:pd.DataFrame, strict:bool=False, source:str="annotations")->"SpaAnnotations":
+        """
+        Parse the vertices of all rows at once. Rows whose vertices can't be parsed get no polygon
+        and are reported with a warning.
+
+        :param frame: pandas dataframe containing the annotation rows.
+        :param strict: raise on rows whose vertices can't be parsed instead of skipping them.
+        :param source: name of the annotations used in the error messages.
+        :return: parsed annotations.
+        """
+        vertices, offsets, rows, errors = parse_vertices(frame["Vertices"])
+        if errors:
+            report = "; ".join(f"row {row}: {message}" for row, message in list(errors.items())[:5])
+            more = f" (and {len(errors) - 5} more)" if len(errors) > 5 else ""
+            if strict:
+                raise ValueError(f"Invalid vertices in {source}: {report}{more}")
+            warnings.warn(f"Skipped {len(errors)} rows with invalid vertices in {source}: {report}{more}")
+        return cls(frame, vertices, offsets, rows, errors)
+
+    @property
+    def image_name(self)->str:
+        """
+        Name of the image file the annotations belong to.
+        """
+        return list(self.frame["Image File"].unique())[0]
+
+    @property
+    def sizes(self)->np.ndarray:
+        """
+        Number of vertices of every polygon.
+        """
+        return np.diff(self.offsets)
+
+    def gather(self, polygons:np.ndarray)->tuple[np.ndarray, np.ndarray]:
+        """
+        Get the vertex indices of a selection of polygons.
+
+        :param polygons: indices of the selected polygons.
+        :return: vertex indices and for every vertex its position in the selection.
+        """
+        starts = self.offsets[polygons]
+        sizes = self.offsets[polygons + 1] - starts
+        owner = np.repeat(np.arange(len(polygons)), sizes)
+        local = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        return np.repeat(starts, sizes) + local, owner
+
+    def _compute_bboxes(self)->np.ndarray:
+        """
+        Compute the bounding box of every polygon.
+
+        :return: (P, 4) array of x_min, y_min, x_max, y_max. Polygons without vertices get NaN.
+        """
+        bboxes = np.full((len(self.rows), 4), np.nan)
+        filled = self.sizes > 0
+        if filled.any():
+            # empty polygons are left out so every segment covers exactly one polygon
+            starts = self.offsets[:-1][filled]
+            bboxes[filled, :2] = np.minimum.reduceat(self.vertices, starts, axis=0)
+            bboxes[filled, 2:] = np.maximum.reduceat(self.vertices, starts, axis=0)
+        return bboxes
+
+
+class GridIndex:
+    """
+    Uniform grid over polygon bounding boxes to look up the polygons near a window.
+    """
+
+    def __init__(self, bboxes:np.ndarray, cell_size:int):
+        """
+        :param bboxes: (P, 4) array of x_min, y_min, x_max, y_max. Must not contain NaN.
+        :param cell_size: edge length of a grid cell in pixels.
+        """
+        self.cell_size = cell_size
+        cells = np.floor(bboxes / cell_size).astype(np.int64).reshape(-1, 4)
+
+        # shift the cells so the grid starts at zero
+        self.origin = cells[:, :2].min(axis=0) if len(cells) else np.zeros(2, dtype=np.int64)
+        cells -= np.tile(self.origin, 2)
+        self.cols = int(cells[:, 2].max()) + 1 if len(cells) else 0
+        self.grid_rows = int(cells[:, 3].max()) + 1 if len(cells) else 0
+
+        # register every polygon in all cells covered by its bounding box
+        nx = cells[:, 2] - cells[:, 0] + 1
+        ny = cells[:, 3] - cells[:, 1] + 1
+        counts = nx * ny
+        ids = np.repeat(np.arange(len(cells)), counts)
+        local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        cx = cells[ids, 0] + local % nx[ids]
+        cy = cells[ids, 1] + local // nx[ids]
+        keys = cy * self.cols + cx
+
+        # store the cell contents in compressed sparse row layout
+        order = np.argsort(keys, kind="stable")
+        self._ids = ids[order]
+        self._starts = np.searchsorted(keys[order], np.arange(self.cols * self.grid_rows + 1))
+
+    def query(self, x_min:float, y_min:float, x_max:float, y_max:float)->np.ndarray:
+        """
+        Get the polygons whose grid cells touch the window.
+
+        :param x_min: left edge of the window.
+        :param y_min: top edge of the window.
+        :param x_max: right edge of the window.
+        :param y_max: bottom edge of the window.
+        :return: sorted indices of the candidate polygons.
+        """
+        cx0 = max(int(np.floor(x_min / self.cell_size)) - self.origin[0], 0)
+        cy0 = max(int(np.floor(y_min / self.cell_size)) - self.origin[1], 0)
+        cx1 = min(int(np.floor(x_max / self.cell_size)) - self.origin[0], self.cols - 1)
+        cy1 = min(int(np.floor(y_max / self.cell_size)) - self.origin[1], self.grid_rows - 1)
+        if cx0 > cx1 or cy0 > cy1:
+            return np.empty(0, dtype=np.int64)
+
+        # the cells of one grid row are contiguous
+        chunks = []
+        for cy in range(cy0, cy1 + 1):
+            start = self._starts[cy * self.cols + cx0]
+            stop = self._starts[cy * self.cols + cx1 + 1]
+            chunks.append(self._ids[start:stop])
+        return np.unique(np.concatenate(chunks))
+
+    def pairs(self, windows:np.ndarray)->tuple[np.ndarray, np.ndarray]:
+        """
+        Get the candidate polygons of every window.
+
+        :param windows: (T, 4) array of x_min, y_min, x_max, y_max.
+        :return: polygon and window indices of all candidate pairs, grouped by window.
+        """
+        polygons = [self.query(*window) for window in windows]
+        counts = [len(candidates) for candidates in polygons]
+        if not polygons:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        return np.concatenate(polygons), np.repeat(np.arange(len(windows)), counts)
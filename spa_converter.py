@@ -1,162 +1,324 @@
 import os
-import shutil
-from glob import glob
-import ast
+import json
 
-import pandas as pd
 import numpy as np
-import cv2
-from tqdm import tqdm
+
+from image_probe import probe_image_size
+from spa_geometry import polygon_areas
+from spa_store import list_annotation_files, load_annotations, annotation_source_path
+from process_pool import run_tasks
+from build_manifest import BuildManifest
+from file_linker import link_file
+from instrumentation import Profiler
+from dataset_shards import ShardWriter, pack_result
+from dataset_yaml import write_dataset_yaml
+
+# export formats, YOLO label files with polygons or boxes and a COCO JSON file
+FORMATS = ("yolo-seg", "yolo-bbox", "coco")
 
 
 class SpaConverter:
     """
-    Convert annotations from SPA to the YOLO format.
+    Convert annotations from SPA to the YOLO and COCO formats.
     """
 
-    def __init__(self, ann_dir:str, img_dir:str, output_dir:str, names:dict, precision:int=3):
+    def __init__(self, ann_dir:str, img_dir:str, output_dir:str, names:dict, precision:int=3, workers:int=1, incremental:bool=False, link_mode:str="copy", profile:str=None, shard_size:int=None,
+                 formats:tuple=("yolo-seg",)):
         """
-        :param ann_dir: path to the annotations directory.
+        :param ann_dir: path to the annotations directory or an annotation store (see SpaStore).
         :param img_dir: path to the images directory.
         :param output_dir: path to the output directory.
         :param names: dictionary containing the class names and their corresponding class ids.
         :param precision: precision of the bounding box coordinates.
+        :param workers: number of processes converting files in parallel.
+        :param incremental: skip annotation files whose inputs are unchanged since the last run
+            and delete the outputs of annotation files that disappeared.
+        :param link_mode: how images are inserted, "copy", "hardlink", "symlink" or "reflink".
+        :param profile: path of a JSON report with the time, files and bytes of every phase, None disables the instrumentation.
+        :param shard_size: pack the images and label files into tar shards of at most this many bytes
+            instead of writing single files (see ShardWriter). Not available on incremental runs.
+        :param formats: export formats, all produced from one parse of every annotation file. "yolo-seg" writes
+            the polygons and "yolo-bbox" the bounding boxes of the instances as YOLO label files. The first YOLO format
+            goes to labels/, which DataSplitter reads, a second one to labels_seg/ or labels_bbox/. "coco" writes
+            all images and instances to annotations.json and is not available on incremental runs.
         """
+        unknown = set(formats) - set(FORMATS)
+        if unknown or not formats:
+            raise ValueError(f"Unknown export formats: {', '.join(sorted(unknown)) or 'none given'}")
+        if shard_size is not None and incremental:
+            raise ValueError("Incremental runs can't write shards")
+        if "coco" in formats and incremental:
+            raise ValueError("Incremental runs can't write a COCO file")
+
         self.annotation_dir = ann_dir
         self.image_dir = img_dir
         self.output_dir = output_dir
         self.names = names
         self.precision = precision
+        self.workers = workers
+        self.incremental = incremental
+        self.link_mode = link_mode
+        self.profiler = Profiler(profile)
+        self.shard_size = shard_size
+        self.formats = tuple(formats)
 
-    def convert(self):
+        # the first YOLO format is the one YOLO and DataSplitter read
+        yolo_formats = [fmt for fmt in self.formats if fmt != "coco"]
+        self.label_dirs = {fmt: "labels" if idx == 0 else "labels_" + fmt.split("-")[1] for idx, fmt in enumerate(yolo_formats)}
+
+    def convert(self)->dict:
         """
-        Convert annotations from SPA to the YOLO format.
+        Convert annotations from SPA to the export formats.
+        :return: dictionary of the annotation files that failed and their error messages.
         """
+        self.profiler.start()
 
-        # create the output directories
-        self._create_directories(self.output_dir)
+        # create the output directories, shards are written directly into the output directory
+        if self.shard_size is None:
+            self._create_directories(self.output_dir)
 
         # create annotations list
-        annotations_list = glob(os.path.join(self.annotation_dir, "*.csv"))
-        
-        # for every file in the annotations list
-        with tqdm(total=len(annotations_list)) as pbar:
-            for ann_file in annotations_list:
+        annotations_list = list_annotation_files(self.annotation_dir)
 
-                # read the csv file
-                df = pd.read_csv(ann_file)
+        # on incremental runs only new or changed files are converted
+        if self.incremental:
+            manifest = BuildManifest(self.output_dir, {"image_dir": self.image_dir, "names": self.names, "precision": self.precision,
+                                                       "formats": self.formats})
+            annotations_list = manifest.pending(annotations_list)
 
-                # checking if atleast 1 designation is present in annotation
-                if df["Designator"].isna().sum() != df.shape[0]:
+        # convert every annotation file, spread across the workers
+        if self.shard_size is None:
+            results, failures = run_tasks(self._convert_file, annotations_list, self.workers, self.profiler)
+        else:
+            # the files of all workers are packed into the shards by this process
+            with ShardWriter(self.output_dir, max_bytes=self.shard_size) as writer:
+                results, failures = run_tasks(self._convert_file, annotations_list, self.workers, self.profiler,
+                                              lambda result: pack_result(writer, result[:2], self.profiler) + result[2:])
 
-                    # image file name, width and height
-                    image_name = list(df["Image File"].unique())[0]
-                    image_width, image_height = self._get_image_width_height(image_name)
+        if self.incremental:
+            manifest.update(annotations_list, results)
+        if "coco" in self.formats:
+            self._create_coco_file(self.output_dir, results)
 
-                    # create label file and add to output directory
-                    self._create_label_file(df, image_name, image_width, image_height)
+        # create yaml file
+        self._create_yaml_file(self.output_dir)
+        self.profiler.finish(files=len(annotations_list), failures=len(failures))
+        return failures
 
-                    # insert image to output directory
-                    self._insert_image_file(image_name)
+    def _convert_file(self, ann_file:str)->tuple[list[str], list[str]]:
+        """
+        Convert one annotation file and insert its image.
+        :param ann_file: path to the annotation file.
+        :return: paths of the input files and of the written files,
+            names and contents of the files when packing into shards,
+            and with the COCO format the image and its instances for the COCO file.
+        """
+        # read and parse the csv file
+        with self.profiler.phase("read_annotations") as phase:
+            annotations = load_annotations(ann_file)
+            phase.read(ann_file)
 
-                # update progress bar   
-                pbar.update(1)
+        # checking if atleast 1 designation is present in annotation
+        coco = "coco" in self.formats
+        if not annotations.frame["Designator"].notna().any():
+            return ([annotation_source_path(ann_file)], []) + ((None,) if coco else ())
 
-        # create yaml file
-        self._create_yaml_file(self.output_dir)
+        # image file name, width and height
+        image_name = annotations.image_name
+        image_width, image_height = self._get_image_width_height(image_name)
+
+        # every format is produced from the same parsed annotations
+        with self.profiler.phase("format_labels"):
+            designators = annotations.frame["Designator"].to_numpy()[annotations.rows]
+            labels = {}
+            if "yolo-seg" in self.formats:
+                labels["yolo-seg"] = self.format_labels(designators, annotations.vertices, annotations.sizes, image_width, image_height)
+            if "yolo-bbox" in self.formats or coco:
+                class_ids, instances, boxes = self._group_instances(annotations, designators)
+            if "yolo-bbox" in self.formats:
+                labels["yolo-bbox"] = self._format_boxes(class_ids, boxes, image_width, image_height)
+            if coco:
+                image = self._coco_image(annotations, image_name, image_width, image_height, class_ids, instances, boxes)
+
+        # create the label files and add them to the output directory
+        file_name = image_name.split(".")[0] + ".txt"
+        outputs = [self._create_label_file(self.label_dirs[fmt], file_name, labels[fmt]) for fmt in self.label_dirs]
+
+        # insert image to output directory
+        outputs.append(self._insert_image_file(image_name))
+        result = ([annotation_source_path(ann_file), f"{self.image_dir}/{image_name}"], outputs)
+        return result + (image,) if coco else result
     
     def _get_image_width_height(self, image_name):
         """
-        Get the width and height of the image.
+        Get the width and height of the image from its file header.
         :param image_name: name of the image file.
         :return: width and height of the image.
         """
-        # read the image
-        image = cv2.imread(self.image_dir + "/" + image_name)
+        with self.profiler.phase("probe_image"):
+            return probe_image_size(self.image_dir + "/" + image_name)
+    
+    def _create_label_file(self, label_dir:str, file_name:str, labels:str):
+        """
+        Create a label file for the image.
+        :param label_dir: name of the label directory.
+        :param file_name: name of the label file.
+        :param labels: content of the label file.
+        :return: path of the label file, its name and content when packing into shards.
+        """
+        if self.shard_size is not None:
+            return f"{label_dir}/{file_name}", labels.encode()
+        label_path = f"{self.output_dir}/{label_dir}/{file_name}"
+        with self.profiler.phase("write_labels") as phase:
+            with open(label_path, "w") as f:
+                f.write(labels)
+            phase.wrote(label_path)
+        return label_path
 
-        # get the width and height of the image
-        height, width, _ = image.shape
+    def format_labels(self, designators:np.ndarray, vertices:np.ndarray, sizes:np.ndarray, image_width:int, image_height:int)->str:
+        """
+        Format polygons as the lines of a YOLO label file.
+        :param designators: designator of every polygon.
+        :param vertices: (N, 2) array with the vertices of all polygons back to back.
+        :param sizes: number of vertices of every polygon.
+        :param image_width: width of the image.
+        :param image_height: height of the image.
+        :return: content of the label file.
+        """
+        # skip polygons whose designation is not present
+        known = np.array([designator in self.names for designator in designators], dtype=bool)
+        polygons = np.flatnonzero(known)
 
-        return width, height
-    
-    def _create_label_file(self, df, image_name, image_width, image_height):
-        """
-        Create the label file for the image.
-        :param df: pandas dataframe containing the annotations.
-        :param file_name: name of the file.
-        """
-        # exchanging the file extension
-        file_name = image_name.split(".")[0]
-        file_name = file_name + ".txt"
-
-        # create the label file
-        with open(self.output_dir + "/labels/" + file_name, "w") as f:
-            # for every row in the dataframe
-            for _, row in df.iterrows():
-
-                # skip row if designation is not present
-                designator = row["Designator"]
-                if designator not in self.names:
-                    continue
-
-                # get the class id and the bounding box coordinates
-                class_id = self.names[designator]
-
-                # try to get the vertices, if not possible continue to the next row
-                try:
-                    vertices = np.array(ast.literal_eval(row["Vertices"]))[0].flatten()
-                except:
-                    continue
-
-                # write the class id and the bounding box coordinates to the file
-                f.write(f"{class_id}")
-                for idx, vertex in enumerate(vertices):
-
-                    # normalize vertex according to the image width and height
-                    if idx % 2 == 0:
-                        vertex = vertex / image_width
-                    else:
-                        vertex = vertex / image_height
-                    vertex = round(vertex, self.precision)
-
-                    # write the vertex to the file
-                    f.write(f" {vertex}")
-                
-                # proceed to the next line
-                f.write("\n")
+        # normalize all vertices according to the image width and height at once
+        vertices = vertices[np.repeat(known, sizes)] / np.array([image_width, image_height])
+        vertices = np.round(vertices, self.precision)
+
+        class_ids = [self.names[designator] for designator in designators[polygons]]
+        return self._format_lines(class_ids, vertices.ravel(), 2 * sizes[polygons])
+
+    def _format_boxes(self, class_ids:list[int], boxes:np.ndarray, image_width:int, image_height:int)->str:
+        """
+        Format bounding boxes as the lines of a YOLO label file.
+        :param class_ids: class id of every box.
+        :param boxes: (B, 4) array of x_min, y_min, x_max, y_max.
+        :param image_width: width of the image.
+        :param image_height: height of the image.
+        :return: content of the label file.
+        """
+        # center and size of all boxes, normalized at once
+        centers = (boxes[:, :2] + boxes[:, 2:]) / 2
+        values = np.column_stack((centers, boxes[:, 2:] - boxes[:, :2])) / np.array([image_width, image_height] * 2)
+        values = np.round(values, self.precision)
+        return self._format_lines(class_ids, values.ravel(), np.full(len(class_ids), 4))
+
+    def _format_lines(self, class_ids:list[int], values:np.ndarray, counts:np.ndarray)->str:
+        """
+        Format the lines of a YOLO label file, every line is a class id followed by its values.
+        :param class_ids: class id of every line.
+        :param values: values of all lines back to back.
+        :param counts: number of values of every line.
+        :return: content of the label file.
+        """
+        # format all values into one buffer
+        values = [repr(value) for value in values.tolist()]
+        stops = np.cumsum(counts)
+        lines = []
+        for class_id, start, stop in zip(class_ids, stops - counts, stops):
+            lines.append(" ".join([f"{class_id}"] + values[start:stop]) + "\n")
+        return "".join(lines)
+
+    def _group_instances(self, annotations, designators:np.ndarray)->tuple[list[int], list[np.ndarray], np.ndarray]:
+        """
+        Group the polygons of every designated row into one instance. A row has several polygons
+        if its component is split into several rings.
+        :param annotations: parsed annotations of the image.
+        :param designators: designator of every polygon.
+        :return: class id, polygon indices and bounding box (x_min, y_min, x_max, y_max) of every instance.
+        """
+        known = np.array([designator in self.names for designator in designators], dtype=bool) & (annotations.sizes > 0)
+        polygons = np.flatnonzero(known)
+        if not len(polygons):
+            return [], [], np.zeros((0, 4))
+
+        # the polygons of a row are consecutive, their boxes are merged with one reduction per corner
+        firsts = np.flatnonzero(np.diff(annotations.rows[polygons], prepend=-1) != 0)
+        bboxes = annotations.bboxes[polygons]
+        boxes = np.column_stack((np.minimum.reduceat(bboxes[:, :2], firsts), np.maximum.reduceat(bboxes[:, 2:], firsts)))
+        class_ids = [self.names[designator] for designator in designators[polygons[firsts]]]
+        return class_ids, np.split(polygons, firsts[1:]), boxes
+
+    def _coco_image(self, annotations, image_name:str, image_width:int, image_height:int, class_ids:list[int],
+                    instances:list[np.ndarray], boxes:np.ndarray)->dict:
+        """
+        Describe the image and its instances for the COCO file, the ids are assigned when the file is written.
+        :param annotations: parsed annotations of the image.
+        :param image_name: name of the image file.
+        :param image_width: width of the image.
+        :param image_height: height of the image.
+        :param class_ids: class id of every instance.
+        :param instances: polygon indices of every instance.
+        :param boxes: (I, 4) array with the bounding box of every instance.
+        :return: image entry with its annotations.
+        """
+        sizes = annotations.sizes
+        areas = polygon_areas(annotations.vertices, np.repeat(np.arange(len(sizes)), sizes), len(sizes))
+        vertices, offsets = annotations.vertices, annotations.offsets
+        entries = []
+        for class_id, polygons, box in zip(class_ids, instances, boxes.tolist()):
+            segmentation = [vertices[offsets[polygon]:offsets[polygon + 1]].ravel().tolist() for polygon in polygons]
+            entries.append({"category_id": class_id, "segmentation": segmentation, "area": float(areas[polygons].sum()),
+                            "bbox": [box[0], box[1], box[2] - box[0], box[3] - box[1]], "iscrowd": 0})
+        return {"file_name": image_name, "width": image_width, "height": image_height, "annotations": entries}
 
     def _insert_image_file(self, image_name):
         """
         Insert the image to the output directory.
         :param image_name: name of the image file.
+        :return: path of the inserted image, its name and content when packing into shards.
         """
-        # copy the image to the output directory
+        # copy or link the image to the output directory
         src = f"{self.image_dir}/{image_name}"
+        if self.shard_size is not None:
+            with self.profiler.phase("read_image") as phase:
+                with open(src, "rb") as f:
+                    data = f.read()
+                phase.read(src)
+            return "images/" + image_name, data
         dst = f"{self.output_dir}/images/{image_name}"
-        shutil.copy(src, dst)
+        with self.profiler.phase("insert_image") as phase:
+            link_file(src, dst, self.link_mode)
+            phase.wrote(dst)
+        return dst
+
+    def _create_coco_file(self, output_dir:str, results:list):
+        """
+        Create the COCO file with all converted images and their instances.
+        :param output_dir: path to the output directory.
+        :param results: results of the annotation files, None for failed files.
+        """
+        images, annotations = [], []
+        for result in results:
+            if result is None or result[2] is None:
+                continue
+            image = dict(result[2], id=len(images) + 1)
+            for entry in image.pop("annotations"):
+                annotations.append(dict(entry, id=len(annotations) + 1, image_id=image["id"]))
+            images.append(image)
+
+        categories = [{"id": class_id, "name": name} for name, class_id in sorted(self.names.items(), key=lambda item: item[1])]
+        coco_path = f"{output_dir}/annotations.json"
+        with self.profiler.phase("write_coco") as phase:
+            with open(coco_path, "w") as f:
+                json.dump({"images": images, "annotations": annotations, "categories": categories}, f)
+            phase.wrote(coco_path)
 
     def _create_yaml_file(self, output_dir):
         """
-        Create the yaml file for the dataset.
+        Create the yaml file for the dataset. The dataset isn't split yet, so both splits point at all images;
+        DataSplitter writes the yaml file of the split dataset with the same classes.
         :param path: path to the output directory.
         """
-        # create the yaml file
-        with open(f"{output_dir}/{output_dir}.yaml", "w") as f:
-            # paths section
-            f.write("\n# Paths\n")
-            f.write(f"path: {output_dir}\n")
-            f.write("train: images/train\n")
-            f.write("val: images/val\n")
-
-            # classes section
-            f.write("\n# Classes\n")
-            f.write(f"nc: {(len(self.names))}\n")
-            f.write("names: [")
-            for name in self.names:
-                f.write(f"{name}")
-                if name != list(self.names.keys())[-1]:
-                    f.write(", ")
-            f.write("]")
+        write_dataset_yaml(output_dir, {"train": "images", "val": "images"}, self.names)
 
     def _create_directories(self, output_dir):
         """
@@ -171,5 +333,6 @@ class SpaConverter:
         if not os.path.exists(output_dir + "/images"):
             os.makedirs(output_dir + "/images")
 
-        if not os.path.exists(output_dir + "/labels"):
-            os.makedirs(output_dir + "/labels")
\ No newline at end of file
+        for label_dir in self.label_dirs.values():
+            if not os.path.exists(f"{output_dir}/{label_dir}"):
+                os.makedirs(f"{output_dir}/{label_dir}")
\ No newline at end of file
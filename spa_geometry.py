@@ -0,0 +1,94 @@
+import numpy as np
+
+
+def bbox_overlap(bboxes:np.ndarray, windows:np.ndarray)->np.ndarray:
+    """
+    Check pairwise if bounding boxes overlap windows.
+    Both arrays broadcast against each other, e.g. (P, 1, 4) against (1, T, 4) tests every box against every window.
+
+    :param bboxes: array of x_min, y_min, x_max, y_max with inclusive maxima.
+    :param windows: array of x_min, y_min, x_max, y_max with exclusive maxima (pixel windows).
+    :return: boolean array, True where a box overlaps a window.
+    """
+    return ((bboxes[..., 0] < windows[..., 2]) & (bboxes[..., 2] >= windows[..., 0]) &
+            (bboxes[..., 1] < windows[..., 3]) & (bboxes[..., 3] >= windows[..., 1]))
+
+
+def clip_polygons(vertices:np.ndarray, owner:np.ndarray, rects:np.ndarray)->tuple[np.ndarray, np.ndarray]:
+    """
+    Clip polygons against rectangles with the Sutherland-Hodgman algorithm.
+    All polygons are clipped at once, one pass per rectangle edge.
+
+    :param vertices: (N, 2) array with the vertices of all polygons back to back.
+    :param owner: (N,) ascending polygon number of every vertex.
+    :param rects: (P, 4) array of x_min, y_min, x_max, y_max per polygon number, all inclusive.
+    :return: clipped vertices and their polygon numbers. Polygons outside their rectangle disappear.
+    """
+    vertices = vertices.astype(np.float64)
+    for axis, bound, keep_greater in ((0, 0, True), (0, 2, False), (1, 1, True), (1, 3, False)):
+        if len(owner) == 0:
+            break
+        vertices, owner = _clip_edge(vertices, owner, rects[:, bound], axis, keep_greater)
+    return vertices, owner
+
+
+def _clip_edge(vertices:np.ndarray, owner:np.ndarray, bounds:np.ndarray, axis:int, keep_greater:bool)->tuple[np.ndarray, np.ndarray]:
+    """
+    Clip all polygons against one axis aligned edge.
+
+    :param vertices: (N, 2) array with the vertices of all polygons back to back.
+    :param owner: (N,) ascending polygon number of every vertex.
+    :param bounds: position of the edge per polygon number.
+    :param axis: 0 for a vertical edge, 1 for a horizontal edge.
+    :param keep_greater: keep the side with coordinates greater or equal to the edge.
+    :return: clipped vertices and their polygon numbers.
+    """
+    # index of the previous vertex, the first vertex of a polygon is preceded by its last one
+    idx = np.arange(len(owner))
+    first = np.r_[True, owner[1:] != owner[:-1]]
+    last = np.r_[owner[1:] != owner[:-1], True]
+    prev = idx - 1
+    prev[first] = idx[last]
+
+    bound = bounds[owner]
+    coord = vertices[:, axis]
+    cur_in = coord >= bound if keep_greater else coord <= bound
+    prev_in = cur_in[prev]
+
+    # intersection of the segment from the previous to the current vertex with the edge
+    cross = cur_in != prev_in
+    start = vertices[prev]
+    delta = vertices - start
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = np.where(cross, (bound - start[:, axis]) / delta[:, axis], 0.0)
+    intersection = start + t[:, None] * delta
+    intersection[:, axis] = np.where(cross, bound, intersection[:, axis])
+
+    # every vertex emits the intersection first and then itself, if present
+    candidates = np.stack((intersection, vertices), axis=1).reshape(-1, 2)
+    emit = np.column_stack((cross, cur_in)).ravel()
+    return candidates[emit], np.repeat(owner, 2)[emit]
+
+
+def polygon_areas(vertices:np.ndarray, owner:np.ndarray, count:int)->np.ndarray:
+    """
+    Compute the areas of all polygons at once with the shoelace formula.
+
+    :param vertices: (N, 2) array with the vertices of all polygons back to back.
+    :param owner: (N,) ascending polygon number of every vertex.
+    :param count: number of polygons.
+    :return: (count,) array of areas, 0 for polygons without vertices.
+    """
+    if len(owner) == 0:
+        return np.zeros(count)
+
+    # index of the next vertex, the last vertex of a polygon is followed by its first one
+    idx = np.arange(len(owner))
+    first = np.r_[True, owner[1:] != owner[:-1]]
+    last = np.r_[owner[1:] != owner[:-1], True]
+    following = idx + 1
+    following[last] = idx[first]
+
+    x, y = vertices[:, 0], vertices[:, 1]
+    cross = x * y[following] - x[following] * y
+    return 0.5 * np.abs(np.bincount(owner, weights=cross, minlength=count))
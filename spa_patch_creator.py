@@ -1,220 +1,407 @@
 import os 
-from glob import glob
-import ast
+import zlib
 
 import pandas as pd
 import numpy as np
 import cv2
-from tqdm import tqdm
+
+from spa_annotations import SpaAnnotations, GridIndex
+from spa_geometry import bbox_overlap, clip_polygons, polygon_areas
+from image_probe import probe_image_size
+from image_rows import open_image_rows
+from process_pool import run_tasks
+from build_manifest import BuildManifest
+from spa_store import list_annotation_files, load_annotations, annotation_source_path
+from instrumentation import Profiler
+from dataset_shards import ShardWriter, pack_result
 
 class SpaPatchCreator:
-    def __init__(self, ann_dir:str, img_dir:str, output_dir:str, patch_size:int):
+    def __init__(self, ann_dir:str, img_dir:str, output_dir:str, patch_size:int, clip_mode:str="clamp", workers:int=1, incremental:bool=False, transform=None, transform_scope:str=None,
+                 stride:int=None, overlap:int=None, placement:str="shift", min_visible_area:float=0.0,
+                 background_ratio:float=None, seed:int=0, profile:str=None, shard_size:int=None,
+                 windowed:bool=False, cache_dir:str=None):
         """
-        :param ann_dir: path to the annotations directory.
+        :param ann_dir: path to the annotations directory or an annotation store (see SpaStore).
         :param img_dir: path to the images directory.
         :param output_dir: path to the output directory.
         :param pathsize: size of the patches in Pixels.
+        :param clip_mode: "clamp" moves vertices outside a patch onto its border,
+            "exact" clips the polygons against the patch rectangle.
+        :param workers: number of processes splitting files in parallel.
+        :param incremental: skip annotation files whose inputs are unchanged since the last run
+            and delete the patches of annotation files that disappeared.
+        :param transform: optional callable applied to the decoded pixels before they are written,
+            e.g. HsiClaheTransform. Must not change the image size.
+        :param transform_scope: required with a transform and only with one, "image" applies it once to the whole image
+            before tiling, "patch" applies it to every patch separately.
+        :param stride: distance between neighbouring patches in pixels, defaults to the patch size.
+        :param overlap: overlap of neighbouring patches in pixels, alternative to the stride.
+        :param placement: "shift" moves the last patch of a row or column back to the image border,
+            "spread" distributes the patches evenly so all neighbours overlap by about the same amount.
+        :param min_visible_area: minimum fraction of an instance's area that has to be inside a patch,
+            smaller slivers are dropped from the patch.
+        :param background_ratio: fraction of the patches without annotations that is written.
+            None writes all patches, 0 only the patches with annotations.
+        :param seed: seed for sampling the background patches.
+        :param profile: path of a JSON report with the time, files and bytes of every phase, None disables the instrumentation.
+        :param shard_size: pack the patches and their annotation files into tar shards of at most this many bytes
+            instead of writing single files (see ShardWriter). Not available on incremental runs.
+        :param windowed: read the image band by band, one row of patches at a time, instead of decoding it completely.
+            Uncompressed BMP files are memory mapped, so the memory is bounded by the patch size times the image width.
+            Not available with transform_scope "image".
+        :param cache_dir: directory in which windowed runs keep compressed images decoded to .npy files, which are
+            memory mapped like BMP files from then on (see open_image_rows). None decodes them completely on every run.
         """
+        if clip_mode not in ("clamp", "exact"):
+            raise ValueError(f"Unknown clip mode: {clip_mode}")
+        if stride is not None and overlap is not None:
+            raise ValueError("Specify either stride or overlap")
+        if placement not in ("shift", "spread"):
+            raise ValueError(f"Unknown placement: {placement}")
+        if transform is not None and transform_scope not in ("image", "patch"):
+            raise ValueError("A transform requires transform_scope \"image\" or \"patch\"")
+        if transform is None and transform_scope is not None:
+            raise ValueError("transform_scope requires a transform")
+        if shard_size is not None and incremental:
+            raise ValueError("Incremental runs can't write shards")
+        if windowed and transform_scope == "image":
+            raise ValueError("Windowed reading requires transform_scope \"patch\"")
+
         self.annotation_dir = ann_dir
         self.image_dir = img_dir
         self.output_dir = output_dir
         self.patch_size = patch_size
+        self.clip_mode = clip_mode
+        self.workers = workers
+        self.incremental = incremental
+        self.transform = transform
+        self.transform_scope = transform_scope
+        if overlap is not None:
+            stride = patch_size - overlap
+        self.stride = stride if stride is not None else patch_size
+        self.placement = placement
+        self.min_visible_area = min_visible_area
+        self.background_ratio = background_ratio
+        self.seed = seed
+        self.profiler = Profiler(profile)
+        self.shard_size = shard_size
+        self.windowed = windowed
+        self.cache_dir = cache_dir
+        if not 0 < self.stride <= patch_size:
+            raise ValueError(f"Stride must be between 1 and the patch size: {self.stride}")
+
+    def split(self)->dict:
+        """Split the Annotations and Images into patches. Output the patches to the output directory.
+
+        :return: dictionary of the annotation files that failed and their error messages.
+        """
+        self.profiler.start()
 
-    def split(self):
-        """Split the Annotations and Images into patches. Output the patches to the output directory."""
-        
-        # create the output directories
-        self._create_directories(self.output_dir)
+        # create the output directories, shards are written directly into the output directory
+        if self.shard_size is None:
+            self._create_directories(self.output_dir)
 
         # create annotations and image path list
-        annotations_list = glob(os.path.join(self.annotation_dir, "*.csv"))
-        
-
-        # for every file in the annotations list
-        with tqdm(total=len(annotations_list)) as pbar:
-            for ann_file in annotations_list:
-                
-                # read the csv file
-                df = pd.read_csv(ann_file)
-                image_name = list(df["Image File"].unique())[0]
-
-                # split the image into patches
-                self._split_image(image_name, self.patch_size)
+        annotations_list = list_annotation_files(self.annotation_dir)
+
+        # on incremental runs only new or changed files are split
+        if self.incremental:
+            params = {"image_dir": self.image_dir, "patch_size": self.patch_size, "clip_mode": self.clip_mode,
+                      "transform": repr(self.transform), "transform_scope": self.transform_scope,
+                      "stride": self.stride, "placement": self.placement, "min_visible_area": self.min_visible_area,
+                      "background_ratio": self.background_ratio, "seed": self.seed}
+            manifest = BuildManifest(self.output_dir, params)
+            annotations_list = manifest.pending(annotations_list)
+
+        # split every annotation file and its image into patches, spread across the workers
+        if self.shard_size is None:
+            results, failures = run_tasks(self._split_file, annotations_list, self.workers, self.profiler)
+        else:
+            # the patches of all workers are packed into the shards by this process
+            with ShardWriter(self.output_dir, max_bytes=self.shard_size) as writer:
+                results, failures = run_tasks(self._split_file, annotations_list, self.workers, self.profiler,
+                                              lambda result: pack_result(writer, result, self.profiler))
+
+        if self.incremental:
+            manifest.update(annotations_list, results)
+        self.profiler.finish(files=len(annotations_list), failures=len(failures))
+        return failures
+
+    def _split_file(self, ann_file:str)->tuple[list[str], list[str]]:
+        """Split one annotation file and its image into patches.
+
+        :param ann_file: path to the annotation file.
+        :return: paths of the input files and of the written patch files,
+            names, contents and sample keys of the patch files when packing into shards.
+        """
+        # read the csv file once
+        with self.profiler.phase("read_annotations") as phase:
+            annotations = load_annotations(ann_file)
+            phase.read(ann_file)
+        image_name = annotations.image_name
 
-                # split the annotation into patches
-                self._split_annotation(ann_file, self.patch_size)
+        # the patch layout only needs the image size from the file header
+        img_path = f"{self.image_dir}/{image_name}"
+        with self.profiler.phase("probe_image"):
+            width, height = probe_image_size(img_path)
+        windows = self.tile_layout(width, height)
+
+        # split the annotation into patches
+        outputs, occupied = self._split_annotation(annotations, ann_file, windows)
+
+        # decide which patches to keep before any pixels are decoded
+        selected = self.select_tiles(image_name, len(windows), occupied)
+
+        # split the image into patches
+        if len(selected):
+            outputs += self._split_image(image_name, windows, selected)
+        if self.shard_size is not None:
+            # annotation and image of a patch are packed next to each other as one sample
+            outputs.sort(key=lambda output: output[2])
+        return [annotation_source_path(ann_file), img_path], outputs
+
+    def select_tiles(self, image_name:str, count:int, occupied:np.ndarray)->np.ndarray:
+        """Select the patches to write. Patches with annotations are always kept, a fraction of the
+        background patches is sampled with a random generator seeded by the seed and the image name.
+
+        :param image_name: name of the image file.
+        :param count: number of patches.
+        :param occupied: indices of the patches with annotations.
+        :return: sorted indices of the selected patches.
+        """
+        if self.background_ratio is None:
+            return np.arange(count)
 
-                # update progres bar
-                pbar.update(1)
-        
+        background = np.setdiff1d(np.arange(count), occupied)
+        rng = np.random.default_rng([self.seed, zlib.crc32(image_name.encode())])
+        sampled = rng.choice(background, int(round(self.background_ratio * len(background))), replace=False)
+        return np.union1d(occupied, sampled)
 
-    def _split_image(self, image_name:str, patch_size:int)->None:
-        """Split the image into patches.
+    def _split_image(self, image_name:str, windows:np.ndarray, selected:np.ndarray)->list[str]:
+        """Split the image into patches. Every patch is written as soon as it is cut out.
 
-        :param image_path: path to the image.
-        :param patch_size: size of the patches in Pixels.
+        :param image_name: name of the image file.
+        :param windows: (T, 4) array with the patch windows.
+        :param selected: indices of the patches to write.
+        :return: paths of the written patches, names, contents and sample keys of the patches when packing into shards.
         """
         img_path = f"{self.image_dir}/{image_name}"
-        image = cv2.imread(img_path)
-        height, width, _ = image.shape
-        patches = []
-
-        # iterate over width and height of the image and extract patches
-        for i in range(0, height, patch_size):
-            for j in range(0, width, patch_size):
-                temp = image[i:i+patch_size, j:j+patch_size]
-                # check if the extracted image is smaller than patch size
-                # and move the starting x and y point to match the given patch size  
-                if temp.shape[0] < patch_size:
-                    i = height - patch_size
-                if temp.shape[1] < patch_size:
-                    j = width - patch_size
-                patch = image[i:i+patch_size, j:j+patch_size]
-                patches.append(patch)
-        
+        rows = None
+        if self.windowed:
+            # the pixels are read band by band when the patches are cut
+            with self.profiler.phase("open_image") as phase:
+                rows = open_image_rows(img_path, self.cache_dir)
+                phase.read(img_path)
+        if rows is None:
+            with self.profiler.phase("decode_image") as phase:
+                image = cv2.imread(img_path)
+                if image is None:
+                    raise ValueError(f"Could not read image: {img_path}")
+                phase.read(img_path)
+
+        # transform the whole image in memory before tiling
+        if self.transform_scope == "image":
+            with self.profiler.phase("transform"):
+                image = self.transform(image)
+
         # split extension from the image name
         image_name = image_name.split(".")[0]
 
         # write patches to the output directory
-        for i, patch in enumerate(patches):
-            cv2.imwrite(f'{self.output_dir}/img/{image_name}_{str(i)}.png', patch)
-    
-    def _split_annotation(self, annotation_path:str, patch_size:int)->None:
+        paths = []
+        band, band_rows = None, None
+        for i in selected:
+            x_min, y_min, x_max, y_max = windows[i]
+            if rows is not None:
+                # the patches are in row order, every band of rows is read once
+                if band_rows != (y_min, y_max):
+                    with self.profiler.phase("read_band"):
+                        band = rows.read(y_min, y_max)
+                    band_rows = (y_min, y_max)
+                patch = band[:, x_min:x_max]
+            else:
+                patch = image[y_min:y_max, x_min:x_max]
+            if self.transform_scope == "patch":
+                with self.profiler.phase("transform"):
+                    patch = self.transform(patch)
+            path = f'{self.output_dir}/img/{image_name}_{str(i)}.png'
+            with self.profiler.phase("encode_patches") as phase:
+                if self.shard_size is None:
+                    cv2.imwrite(path, patch)
+                    phase.wrote(path)
+                    paths.append(path)
+                else:
+                    paths.append((f"img/{image_name}_{str(i)}.png", cv2.imencode(".png", patch)[1].tobytes(), f"{image_name}_{i}"))
+        return paths
+
+    def _split_annotation(self, annotations:SpaAnnotations, annotation_path:str, windows:np.ndarray)->tuple[list[str], np.ndarray]:
         """Split the annotation into patches.
 
+        :param annotations: parsed annotations of the image.
         :param annotation_path: path to the annotation file.
-        :param patch_size: size of the patches in Pixels.
+        :param windows: (T, 4) array with the patch windows.
+        :return: paths of the written patch annotation files (names, contents and sample keys when packing into shards)
+            and the indices of the patches with annotations.
         """
-        df = pd.read_csv(annotation_path)
-        image_name = df["Image File"].unique()[0]
-        img_path = f"{self.image_dir}/{image_name}"
-        image = cv2.imread(img_path)
-        height, width, _ = image.shape
-
-        patch_counter = 0
-        for i in range(0, height, patch_size):
-            for j in range(0, width, patch_size):
-                if i + patch_size > height:
-                    i = height - patch_size
-                if j + patch_size > width:
-                    j = width - patch_size
-
-                # Filter and process rows for the current patch
-                new_rows = []
-                for _, row in df.iterrows():
-                    new_row = self._process_row(row, i, j, patch_size, patch_counter)
-                    if new_row is not None:
-                        new_rows.append(new_row)
-                
-                # Create patch annotation file
-                self._create_patch_annotation(new_rows, df.columns, annotation_path, patch_counter)
-                patch_counter += 1
-
-    def _process_row(self, row:pd.Series, i:int, j:int, patch_size:int, patch_counter:int)->pd.Series:
-        """
-        Process each annotation row to check if it fits in the current patch and adjust coordinates.
-
-        :param row: A row from the annotation DataFrame.
-        :param i: Current vertical (y-axis) starting position of the patch.
-        :param j: Current horizontal (x-axis) starting position of the patch.
-        :param patch_size: Size of the patches in pixels.
-        :param patch_counter: Index for the current patch.
-        :return: The modified row if it fits in the patch, otherwise None.
-        """
-        try:
-            vertices = self._get_valid_vertices(row)
-        except ValueError:
-            return None  # Skip rows with invalid vertices
-
-        if vertices is None:
-            return None  # Skip rows without valid designators
-
-        x_bool = self._check_range(vertices[0::2], j, j + patch_size)
-        y_bool = self._check_range(vertices[1::2], i, i + patch_size)
-        if not x_bool or not y_bool:
-            return None  # Skip if coordinates are not within the patch boundaries
-
-        new_vertices = self._adjust_patch_boundaries(vertices, i, j, patch_size)
-        
-        row["Vertices"] = str([new_vertices])
-        row["Image File"] = f"{row['Image File'].split('.')[0]}_{patch_counter}.png"
-        return row
-
-    def _get_valid_vertices(self, row:pd.Series)->np.ndarray:
-        """
-        Extract and validate vertices from the annotation row.
-
-        :param row: A row from the annotation DataFrame.
-        :return: A flattened NumPy array of vertices if valid, otherwise None.
-        """
-        try:
-            vertices = np.array(ast.literal_eval(row["Vertices"]))[0].flatten()
-            if pd.isna(row["Designator"]):
-                return None
-            return vertices
-        except (ValueError, IndexError):
-            return None  # Handle cases where vertices can't be parsed
-
-    def _adjust_patch_boundaries(self, vertices:np.ndarray, i:int, j:int, patch_size:int)->list:
-        """
-        Adjust the vertices to fit within the patch boundaries.
-
-        :param vertices: NumPy array of vertex coordinates.
-        :param i: Current vertical (y-axis) starting position of the patch.
-        :param j: Current horizontal (x-axis) starting position of the patch.
-        :param patch_size: Size of the patches in pixels.
-        :return: List of adjusted vertices within the patch boundaries.
-        """
-        new_vertices = []
-        for idx, vertex in enumerate(vertices):
-            if idx % 2 == 0:  # x-coordinate
-                if vertex < j:
-                    new_vertices.append(0)
-                elif vertex > (j + patch_size):
-                    new_vertices.append(patch_size-1)
-                else:
-                    new_vertices.append(int(vertex - j))
-            else:  # y-coordinate
-                if vertex < i:
-                    new_vertices.append(0)
-                elif vertex > (i + patch_size):
-                    new_vertices.append(patch_size-1)
-                else:
-                    new_vertices.append(int(vertex - i))
-        
-        new_vertices = np.array(new_vertices).reshape(-1, 2)
-        _, idx = np.unique(new_vertices, axis=0, return_index=True)
-        return new_vertices[np.sort(idx)].tolist()
+        with self.profiler.phase("tile_annotations"):
+            polygons, tiles, vertices, sizes = self.assign_patches(annotations, windows)
+        new_vertices = [polygon.tolist() for polygon in np.split(vertices, np.cumsum(sizes)[:-1])] if len(sizes) else []
+
+        # Create patch annotation files, the pairs are grouped by patch
+        bounds = np.searchsorted(tiles, np.arange(len(windows) + 1))
+        paths = []
+        for patch_counter in range(len(windows)):
+            start, stop = bounds[patch_counter], bounds[patch_counter + 1]
+
+            # the rings of one row are consecutive and written back into a single row
+            rows = annotations.rows[polygons[start:stop]]
+            firsts = np.flatnonzero(np.diff(rows, prepend=-1) != 0)
+            rings = new_vertices[start:stop]
+            patch_df = annotations.frame.iloc[rows[firsts]].copy()
+            patch_df["Vertices"] = [str(rings[a:b]) for a, b in zip(firsts, np.append(firsts[1:], len(rows)))]
+            patch_df["Image File"] = [f"{name.split('.')[0]}_{patch_counter}.png" for name in patch_df["Image File"]]
+            path = self._create_patch_annotation(patch_df, annotation_path, patch_counter, annotations.image_name)
+            if path is not None:
+                paths.append(path)
+        return paths, np.unique(tiles)
+
+    def assign_patches(self, annotations:SpaAnnotations, windows:np.ndarray)->tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Distribute the designated polygons to the patches and adjust their vertices to the patch coordinates.
+
+        :param annotations: parsed annotations of the image.
+        :param windows: (T, 4) array with the patch windows.
+        :return: polygon and patch index of every pair grouped by patch, the adjusted vertices
+            of all pairs back to back and the number of vertices of every pair.
+        """
+        # only polygons with vertices and a designator are distributed to the patches
+        designated = annotations.frame["Designator"].notna().to_numpy()
+        polygons = np.flatnonzero(designated[annotations.rows] & (annotations.sizes > 0))
+
+        # test the candidate pairs of the grid index against the patch windows in one batch
+        grid = GridIndex(annotations.bboxes[polygons], self.patch_size)
+        candidates, tiles = grid.pairs(windows)
+        overlap = bbox_overlap(annotations.bboxes[polygons[candidates]], windows[tiles])
+        polygons, tiles = polygons[candidates[overlap]], tiles[overlap]
+
+        # drop slivers of instances that are mostly outside the patch
+        if self.min_visible_area > 0:
+            visible = self._visible_fraction(annotations, polygons, tiles, windows) >= self.min_visible_area
+            polygons, tiles = polygons[visible], tiles[visible]
+
+        # adjust the coordinates of all pairs at once
+        vertices, sizes, kept = self._adjust_patch_boundaries(annotations, polygons, tiles, windows)
+        return polygons[kept], tiles[kept], vertices, sizes
+
+    def tile_layout(self, width:int, height:int)->np.ndarray:
+        """
+        Compute the patch windows of an image in patch order, row by row.
 
-    def _create_patch_annotation(self, new_rows:list, columns:pd.Index, annotation_path:str, patch_counter:int)->None:
+        :param width: width of the image.
+        :param height: height of the image.
+        :return: (T, 4) array of x_min, y_min, x_max, y_max with exclusive maxima.
         """
-        Create and save a new annotation file for a patch.
+        ys = self._tile_positions(height)
+        xs = self._tile_positions(width)
+        y_min, x_min = np.repeat(ys, len(xs)), np.tile(xs, len(ys))
+        return np.column_stack((x_min, y_min, x_min + self.patch_size, y_min + self.patch_size))
 
-        :param new_rows: List of rows to include in the patch annotation.
-        :param columns: The columns of the original DataFrame.
-        :param annotation_path: Path to the original annotation file.
-        :param patch_counter: Index for the current patch.
+    def _tile_positions(self, length:int)->np.ndarray:
+        """
+        Compute the patch start positions along one image axis.
+        The last patch always ends at the image border.
+
+        :param length: width or height of the image.
+        :return: start positions in pixels.
+        """
+        last = length - self.patch_size
+        positions = np.arange(0, last, self.stride)
+        if len(positions) == 0 or positions[-1] < last:
+            positions = np.append(positions, last)
+
+        # spread the overlap of the border patch evenly over all neighbours
+        if self.placement == "spread" and len(positions) > 1:
+            positions = np.rint(np.linspace(0, last, len(positions))).astype(np.int64)
+        return positions
+
+    def _visible_fraction(self, annotations:SpaAnnotations, polygons:np.ndarray, tiles:np.ndarray, windows:np.ndarray)->np.ndarray:
+        """
+        Compute which fraction of every instance's area is inside the patch, for all pairs at once.
+
+        :param annotations: parsed annotations of the image.
+        :param polygons: polygon index of every pair.
+        :param tiles: patch index of every pair.
+        :param windows: (T, 4) array with the patch windows.
+        :return: visible fraction per pair, 1 for instances without area.
         """
-        if new_rows:
-            temp_df = pd.DataFrame(new_rows, columns=columns)
-            annotation_name = os.path.basename(annotation_path).split(".")[0]
-            path = f'{self.output_dir}/ann/{annotation_name}_{str(patch_counter)}.csv'
-            temp_df.to_csv(path, index=False)
+        vertex_idx, owner = annotations.gather(polygons)
+        vertices = annotations.vertices[vertex_idx]
+        total = polygon_areas(vertices, owner, len(polygons))
 
+        clipped, clipped_owner = clip_polygons(vertices, owner, windows[tiles])
+        visible = polygon_areas(clipped, clipped_owner, len(polygons))
+        return np.divide(visible, total, out=np.ones(len(polygons)), where=total > 0)
 
-    def _check_range(self, arr:np.ndarray, min_value:int, max_value:int)->bool:
+    def _adjust_patch_boundaries(self, annotations:SpaAnnotations, polygons:np.ndarray, tiles:np.ndarray, windows:np.ndarray)->tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Adjust the vertices of polygon/patch pairs to fit within the patch boundaries.
+        With clip_mode "clamp" vertices outside the patch are moved onto its border,
+        with "exact" the polygons are clipped against the patch rectangle.
+
+        :param annotations: parsed annotations of the image.
+        :param polygons: polygon index of every pair.
+        :param tiles: patch index of every pair.
+        :param windows: (T, 4) array with the patch windows.
+        :return: adjusted vertices of the kept pairs back to back, their number per kept pair
+            and a boolean mask of the pairs that were kept.
         """
-        Check if any values in the array are in the range of min and max.
+        vertex_idx, owner = annotations.gather(polygons)
+        vertices = annotations.vertices[vertex_idx]
+        origin = windows[tiles, :2]
+        size = windows[tiles, 2:] - origin
+
+        if self.clip_mode == "exact":
+            # clip against the last pixel row and column of the patch
+            rects = np.column_stack((origin, origin + size - 1))
+            vertices, owner = clip_polygons(vertices, owner, rects)
+            new_vertices = np.rint(vertices - origin[owner])
+        else:
+            start, stop = origin[owner], origin[owner] + size[owner]
+            new_vertices = np.where(vertices < start, 0, np.where(vertices > stop, size[owner] - 1, vertices - start))
+        new_vertices = new_vertices.astype(np.int64)
+
+        # drop repeated points of every polygon and keep the first occurrence
+        keys = np.column_stack((owner, new_vertices))
+        _, idx = np.unique(keys, axis=0, return_index=True)
+        idx = np.sort(idx)
+        new_vertices, owner = new_vertices[idx], owner[idx]
+
+        # clipped polygons need at least three points to cover an area inside the patch
+        counts = np.bincount(owner, minlength=len(polygons))
+        kept = counts >= (3 if self.clip_mode == "exact" else 1)
+        return new_vertices[kept[owner]], counts[kept], kept
+
+    def _create_patch_annotation(self, patch_df:pd.DataFrame, annotation_path:str, patch_counter:int, image_name:str)->str|tuple|None:
+        """
+        Create and save a new annotation file for a patch.
 
-        :param arr: NumPy array of values.
-        :param min_value: Minimum value of the range.
-        :param max_value: Maximum value of the range.
-        :return: True if any values are in the range, False otherwise.
+        :param patch_df: Rows to include in the patch annotation.
+        :param annotation_path: Path to the original annotation file.
+        :param patch_counter: Index for the current patch.
+        :param image_name: name of the image file, the patch image and annotation form a sample named after it.
+        :return: path of the written file, its name, content and sample key when packing into shards,
+            None if the patch has no annotations.
         """
-        required_values = np.arange(min_value, max_value)
-        
-        # check if any of required values are in the array
-        return bool(np.any(np.isin(arr, required_values)))
+        if patch_df.empty:
+            return None
+        annotation_name = os.path.basename(annotation_path).split(".")[0]
+        if self.shard_size is not None:
+            sample = f"{image_name.split('.')[0]}_{patch_counter}"
+            return f"ann/{annotation_name}_{str(patch_counter)}.csv", patch_df.to_csv(index=False).encode(), sample
+        path = f'{self.output_dir}/ann/{annotation_name}_{str(patch_counter)}.csv'
+        with self.profiler.phase("write_annotations") as phase:
+            patch_df.to_csv(path, index=False)
+            phase.wrote(path)
+        return path
 
     def _create_directories(self, output_dir:str)->None:
         """
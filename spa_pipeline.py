@@ -0,0 +1,301 @@
+import os
+import json
+import copy
+import argparse
+import threading
+
+import numpy as np
+import cv2
+
+from spa_patch_creator import SpaPatchCreator
+from spa_converter import SpaConverter
+from designator_replace import DesignatorReplace
+from data_splitter import assign_split
+from hsi_clahe_converter import HsiClaheTransform
+from image_probe import probe_image_size
+from image_rows import ImageRows, open_image_rows
+from instrumentation import Profiler
+from spa_store import list_annotation_files, load_annotations
+from stage_graph import Stage, run_stages
+from dataset_yaml import write_dataset_yaml
+
+# options of the SpaPatchCreator the pipeline honours, the others concern its own processes and outputs
+PATCH_OPTIONS = ("clip_mode", "transform", "transform_scope", "stride", "overlap", "placement", "min_visible_area",
+                 "background_ratio", "windowed", "cache_dir")
+
+class SpaPipeline:
+    """
+    Convert S3A annotations and images into a split YOLO dataset in one streaming run.
+    Every sample goes from its annotation file and image to its patches in the final
+    train/val directories without intermediate directories. The stages run in thread pools
+    connected by bounded queues: parsing and tiling the annotations, decoding the image,
+    cutting the patches and encoding and writing them.
+    """
+
+    def __init__(self, ann_dir:str, img_dir:str, output_dir:str, names:dict, patch_size:int, test_size:float=0.2, splits:dict=None,
+                 seed:int=None, precision:int=3, replace_dict:dict=None, workers:int=4, queue_size:int=4, profile:str=None,
+                 **patch_options):
+        """
+        :param ann_dir: path to the annotations directory or an annotation store (see SpaStore).
+        :param img_dir: path to the images directory.
+        :param output_dir: path to the output directory.
+        :param names: dictionary containing the class names and their corresponding class ids.
+        :param patch_size: size of the patches in pixels.
+        :param test_size: size of the validation set.
+        :param splits: fractions of the splits, e.g. {"train": 0.7, "val": 0.2, "test": 0.1}.
+            Defaults to train and val according to test_size.
+        :param seed: salt of the hash that assigns the source images to the splits.
+        :param precision: precision of the label coordinates.
+        :param replace_dict: optional designator replacements, see DesignatorReplace.
+        :param workers: number of threads per stage.
+        :param queue_size: maximum number of items waiting in front of a stage.
+        :param profile: path of a JSON report with the time, files and bytes of every phase and the statistics
+            of every stage, None disables the instrumentation.
+        :param patch_options: further options of the SpaPatchCreator, one of clip_mode, transform, transform_scope,
+            stride, overlap, placement, min_visible_area, background_ratio, windowed and cache_dir.
+        """
+        unsupported = sorted(set(patch_options) - set(PATCH_OPTIONS))
+        if unsupported:
+            raise ValueError(f"Patch options not supported by the pipeline: {unsupported}")
+        if splits is None:
+            splits = {"train": 1 - test_size, "val": test_size}
+        if not np.isclose(sum(splits.values()), 1.0):
+            raise ValueError(f"Split fractions must sum up to 1: {splits}")
+
+        self.annotation_dir = ann_dir
+        self.image_dir = img_dir
+        self.output_dir = output_dir
+        self.names = names
+        self.splits = splits
+        self.seed = seed
+        self.workers = workers
+        self.queue_size = queue_size
+        self.profiler = Profiler(profile)
+        self.patch_creator = SpaPatchCreator(ann_dir, img_dir, output_dir, patch_size, **patch_options)
+        self.converter = SpaConverter(ann_dir, img_dir, output_dir, names, precision)
+        self.replacer = DesignatorReplace(ann_dir, output_dir, replace_dict) if replace_dict else None
+        self._local = threading.local()
+
+    def run(self)->tuple[dict, dict]:
+        """
+        Run the pipeline over all annotation files.
+
+        :return: run time and statistics per stage, and a dictionary of the failed samples and their error messages.
+        """
+        self.profiler.start()
+
+        # create the output directories
+        self._create_directories(self.output_dir)
+
+        stages = [
+            Stage("annotations", self._tile_annotations, self.workers),
+            Stage("decode", self._decode_image, self.workers),
+            Stage("patches", self._cut_patches, self.workers),
+            Stage("write", self._write_patch, self.workers),
+        ]
+        items = [(os.path.basename(path), path) for path in list_annotation_files(self.annotation_dir)]
+        report, failures = run_stages(items, stages, self.queue_size)
+
+        # create yaml file
+        self._create_yaml_file(self.output_dir)
+        self.profiler.finish(files=len(items), failures=len(failures), stages=report["stages"])
+        return report, failures
+
+    def _tile_annotations(self, item:tuple):
+        """
+        Parse an annotation file, distribute its polygons to the patches and select the patches to write.
+
+        :param item: name and path of the annotation file.
+        :return: the sample with its patch layout, nothing if it has no designators or patches.
+        """
+        name, ann_file = item
+        with self.profiler.phase("read_annotations") as phase:
+            annotations = load_annotations(ann_file)
+            phase.read(ann_file)
+        if self.replacer is not None:
+            self.replacer.replace_frame(annotations.frame)
+        if not annotations.frame["Designator"].notna().any():
+            return
+
+        # the patch layout only needs the image size from the file header
+        image_name = annotations.image_name
+        width, height = probe_image_size(f"{self.image_dir}/{image_name}")
+        with self.profiler.phase("tile_annotations"):
+            windows = self.patch_creator.tile_layout(width, height)
+            polygons, tiles, vertices, sizes = self.patch_creator.assign_patches(annotations, windows)
+            selected = self.patch_creator.select_tiles(image_name, len(windows), np.unique(tiles))
+        if len(selected):
+            layout = (polygons, tiles, vertices, sizes, windows, selected)
+            yield name, image_name, annotations, layout
+
+    def _decode_image(self, item:tuple):
+        """
+        Decode the image of a sample and apply an image wide transform. Windowed runs only open the
+        image, its rows are read band by band when the patches are cut.
+
+        :param item: the sample with its patch layout.
+        :return: the sample with its pixels or rows.
+        """
+        name, image_name, annotations, layout = item
+        img_path = f"{self.image_dir}/{image_name}"
+        image = None
+        if self.patch_creator.windowed:
+            with self.profiler.phase("open_image") as phase:
+                image = open_image_rows(img_path, self.patch_creator.cache_dir)
+                phase.read(img_path)
+        if image is None:
+            with self.profiler.phase("decode_image") as phase:
+                image = cv2.imread(img_path)
+                if image is None:
+                    raise ValueError(f"Could not read image: {img_path}")
+                phase.read(img_path)
+        if self.patch_creator.transform_scope == "image":
+            with self.profiler.phase("transform"):
+                image = self._transform()(image)
+        yield name, image_name, annotations, layout, image
+
+    def _cut_patches(self, item:tuple):
+        """
+        Cut the selected patches of a sample and format their labels.
+
+        :param item: the sample with its patch layout and pixels or rows.
+        :return: per patch its name, split, pixels and label file content.
+        """
+        name, image_name, annotations, layout, image = item
+        polygons, tiles, vertices, sizes, windows, selected = layout
+        stem = image_name.split(".")[0]
+
+        # all patches of one source image go to the same split
+        split = assign_split(stem, self.splits, self.seed)
+        designators = annotations.frame["Designator"].to_numpy()[annotations.rows[polygons]]
+        bounds = np.searchsorted(tiles, np.arange(len(windows) + 1))
+        vertex_bounds = np.concatenate(([0], np.cumsum(sizes)))
+        band, band_rows = None, None
+        for i in selected:
+            x_min, y_min, x_max, y_max = windows[i]
+            if isinstance(image, ImageRows):
+                # the patches are in row order, every band of rows is read once
+                if band_rows != (y_min, y_max):
+                    with self.profiler.phase("read_band"):
+                        band = image.read(y_min, y_max)
+                    band_rows = (y_min, y_max)
+                patch = band[:, x_min:x_max]
+            else:
+                patch = image[y_min:y_max, x_min:x_max]
+            if self.patch_creator.transform_scope == "patch":
+                with self.profiler.phase("transform"):
+                    patch = self._transform()(patch)
+
+            # labels are normalized by the patch size like in the converted patch files
+            start, stop = bounds[i], bounds[i + 1]
+            labels = self.converter.format_labels(designators[start:stop], vertices[vertex_bounds[start]:vertex_bounds[stop]],
+                                                   sizes[start:stop], x_max - x_min, y_max - y_min)
+            yield f"{stem}_{i}", split, patch, labels
+
+    def _write_patch(self, item:tuple):
+        """
+        Encode and write a patch and its label file to its split.
+
+        :param item: name, split, pixels and label file content of the patch.
+        :return: nothing, the patch is the end of the pipeline.
+        """
+        name, split, patch, labels = item
+        path = f"{self.output_dir}/{split}/images/{name}.png"
+        with self.profiler.phase("encode_patches") as phase:
+            if not cv2.imwrite(path, patch):
+                raise ValueError(f"Could not write image: {path}")
+            phase.wrote(path)
+
+        # patches without objects are background images without a label file
+        if labels:
+            label_path = f"{self.output_dir}/{split}/labels/{name}.txt"
+            with self.profiler.phase("write_labels") as phase:
+                with open(label_path, "w") as f:
+                    f.write(labels)
+                phase.wrote(label_path)
+        return ()
+
+    def _transform(self):
+        """
+        Get the transform of the current thread, transforms must not be shared between threads.
+
+        :return: the transform.
+        """
+        transform = getattr(self._local, "transform", None)
+        if transform is None:
+            transform = copy.copy(self.patch_creator.transform)
+            self._local.transform = transform
+        return transform
+
+    def _create_yaml_file(self, output_dir:str):
+        """
+        Create the yaml file for the dataset.
+
+        :param output_dir: path to the output directory.
+        """
+        write_dataset_yaml(output_dir, {split: f"{split}/images" for split in self.splits}, self.names)
+
+    def _create_directories(self, output_dir:str):
+        """
+        Create the image and label directories of every split.
+
+        :param output_dir: path to the output directory.
+        """
+        for split in self.splits:
+            os.makedirs(f"{output_dir}/{split}/images", exist_ok=True)
+            os.makedirs(f"{output_dir}/{split}/labels", exist_ok=True)
+
+
+def main(argv:list[str]=None)->None:
+    """
+    Run the pipeline from the command line and print the statistics of every stage.
+
+    :param argv: command line arguments, defaults to sys.argv.
+    """
+    parser = argparse.ArgumentParser(description="Convert an S3A dataset into a split YOLO dataset in one streaming run.")
+    parser.add_argument("ann_dir", help="annotations directory or annotation store")
+    parser.add_argument("img_dir", help="images directory")
+    parser.add_argument("output_dir", help="output directory")
+    parser.add_argument("--names", required=True, help="comma separated class names, the position is the class id")
+    parser.add_argument("--patch-size", type=int, default=640)
+    parser.add_argument("--stride", type=int, default=None)
+    parser.add_argument("--clip-mode", choices=("clamp", "exact"), default="clamp")
+    parser.add_argument("--background-ratio", type=float, default=None, help="fraction of the patches without annotations to keep")
+    parser.add_argument("--test-size", type=float, default=0.2)
+    parser.add_argument("--splits", default=None, help="split fractions, e.g. train=0.7,val=0.2,test=0.1")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--precision", type=int, default=3)
+    parser.add_argument("--clahe", type=float, default=None, help="apply HSI + CLAHE with this clip limit to every image")
+    parser.add_argument("--replace", default=None, help="json file with designator replacements, see DesignatorReplace")
+    parser.add_argument("--workers", type=int, default=4, help="threads per stage")
+    parser.add_argument("--queue-size", type=int, default=4)
+    parser.add_argument("--windowed", action="store_true", help="read the images band by band instead of decoding them completely")
+    parser.add_argument("--cache-dir", default=None, help="directory of decoded compressed images for windowed runs")
+    parser.add_argument("--profile", default=None, help="path of a JSON report with the time, files and bytes of every phase")
+    args = parser.parse_args(argv)
+
+    splits = None
+    if args.splits:
+        splits = {split: float(fraction) for split, fraction in (entry.split("=") for entry in args.splits.split(","))}
+    replace_dict = None
+    if args.replace:
+        with open(args.replace) as f:
+            replace_dict = json.load(f)
+    transform = HsiClaheTransform(args.clahe) if args.clahe is not None else None
+
+    pipeline = SpaPipeline(args.ann_dir, args.img_dir, args.output_dir, {name: idx for idx, name in enumerate(args.names.split(","))},
+                           args.patch_size, args.test_size, splits, args.seed, args.precision, replace_dict, args.workers, args.queue_size,
+                           args.profile, stride=args.stride, clip_mode=args.clip_mode, background_ratio=args.background_ratio,
+                           transform=transform, transform_scope="image" if transform is not None else None,
+                           windowed=args.windowed, cache_dir=args.cache_dir)
+    report, failures = pipeline.run()
+
+    # per stage throughput
+    print(f"{'stage':<12}{'items':>10}{'outputs':>10}{'items/s':>12}{'busy':>8}")
+    for name, stats in report["stages"].items():
+        print(f"{name:<12}{stats['items']:>10}{stats['outputs']:>10}{stats['items_per_s']:>12.2f}{stats['utilization']:>8.0%}")
+    print(f"total {report['total_s']:.2f}s, {len(failures)} failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+import os
+import json
+from glob import glob
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from spa_annotations import SpaAnnotations
+
+
+class SpaStore:
+    """
+    Sharded columnar store of parsed S3A annotation files.
+    Every shard is a compressed NumPy .npz file holding the columns of its annotation files
+    and the parsed polygons as flat vertex buffers with offsets.
+    """
+
+    INDEX_NAME = "spa_store.json"
+
+    def __init__(self, store_dir:str):
+        """
+        :param store_dir: path to the store directory.
+        """
+        self.store_dir = store_dir
+        self._index = None
+
+    @classmethod
+    def is_store(cls, path:str)->bool:
+        """
+        Check if a directory is a store.
+
+        :param path: path to the directory.
+        :return: True if the directory contains a store index.
+        """
+        return os.path.isfile(os.path.join(path, cls.INDEX_NAME))
+
+    def ingest(self, ann_dir:str, shard_size:int=256)->None:
+        """
+        Parse all annotation files of a directory once and write them to the store.
+
+        :param ann_dir: path to the annotations directory.
+        :param shard_size: maximum number of annotation files per shard.
+        """
+        os.makedirs(self.store_dir, exist_ok=True)
+        index_path = os.path.join(self.store_dir, self.INDEX_NAME)
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        index = {}
+        shard = []
+
+        annotations_list = sorted(glob(os.path.join(ann_dir, "*.csv")))
+        with tqdm(total=len(annotations_list)) as pbar:
+            for ann_file in annotations_list:
+                annotations = SpaAnnotations.from_csv(ann_file)
+
+                # a shard holds files with the same columns only
+                if shard and (len(shard) == shard_size or list(shard[0][1].frame.columns) != list(annotations.frame.columns)):
+                    self._write_shard(shard, index)
+                    shard = []
+                shard.append((os.path.basename(ann_file), annotations))
+                pbar.update(1)
+        if shard:
+            self._write_shard(shard, index)
+
+        # the index is written last, so an interrupted ingest leaves no valid store behind
+        with open(index_path, "w") as f:
+            json.dump({"version": 1, "files": index}, f)
+        self._index = index
+
+    def names(self)->list[str]:
+        """
+        Get the names of the stored annotation files.
+
+        :return: sorted file names.
+        """
+        return sorted(self._get_index())
+
+    def load(self, name:str)->SpaAnnotations:
+        """
+        Load the parsed annotations of a stored file.
+
+        :param name: name of the annotation file.
+        :return: parsed annotations.
+        """
+        position, arrays = self._locate(name)
+        p0, p1 = arrays["file_polygons"][position:position + 2]
+        v0, v1 = arrays["offsets"][p0], arrays["offsets"][p1]
+
+        frame = self._frame(arrays, position)
+        return SpaAnnotations(frame, arrays["vertices"][v0:v1], arrays["offsets"][p0:p1 + 1] - v0, arrays["rows"][p0:p1])
+
+    def load_frame(self, name:str)->pd.DataFrame:
+        """
+        Load only the columns of a stored file.
+
+        :param name: name of the annotation file.
+        :return: pandas dataframe with the annotation rows.
+        """
+        position, arrays = self._locate(name)
+        return self._frame(arrays, position)
+
+    def shard_path(self, name:str)->str:
+        """
+        Get the path of the shard holding a file.
+
+        :param name: name of the annotation file.
+        :return: path to the shard.
+        """
+        return os.path.join(self.store_dir, self._get_index()[name]["shard"])
+
+    def _locate(self, name:str)->tuple[int, dict]:
+        """
+        Find a stored file.
+
+        :param name: name of the annotation file.
+        :return: position of the file in the shard and the shard arrays.
+        """
+        shard_path = self.shard_path(name)
+        return self._get_index()[name]["position"], _read_shard(shard_path, os.stat(shard_path).st_mtime_ns)
+
+    def _frame(self, arrays:dict, position:int)->pd.DataFrame:
+        """
+        Rebuild the dataframe of a stored file.
+
+        :param arrays: shard arrays.
+        :param position: position of the file in the shard.
+        :return: pandas dataframe with the annotation rows.
+        """
+        r0, r1 = arrays["file_rows"][position:position + 2]
+        columns = {}
+        for idx, column in enumerate(arrays["columns"]):
+            values = arrays[f"col{idx}"][r0:r1]
+            missing = arrays[f"na{idx}"][r0:r1]
+            if values.dtype.kind == "U" and missing.any():
+                values = values.astype(object)
+                values[missing] = np.nan
+            columns[str(column)] = values
+        return pd.DataFrame(columns)
+
+    def _write_shard(self, shard:list, index:dict)->None:
+        """
+        Write a shard and register its files in the index.
+
+        :param shard: list of file names and parsed annotations.
+        :param index: index of the stored files.
+        """
+        shard_name = f"shard_{len(set(entry['shard'] for entry in index.values())):05d}.npz"
+        frames = [annotations.frame for _, annotations in shard]
+        frame = pd.concat(frames, ignore_index=True)
+
+        # concatenate the polygon buffers, offsets continue across files
+        vertex_counts = [len(annotations.vertices) for _, annotations in shard]
+        vertex_starts = np.concatenate(([0], np.cumsum(vertex_counts)))
+        offsets = [annotations.offsets[:-1] + start for (_, annotations), start in zip(shard, vertex_starts)]
+        arrays = {
+            "columns": np.array(frame.columns, dtype=str),
+            "file_rows": np.concatenate(([0], np.cumsum([len(f) for f in frames]))),
+            "file_polygons": np.concatenate(([0], np.cumsum([len(annotations.rows) for _, annotations in shard]))),
+            "vertices": np.concatenate([annotations.vertices for _, annotations in shard]),
+            "offsets": np.concatenate(offsets + [vertex_starts[-1:]]).astype(np.int64),
+            "rows": np.concatenate([annotations.rows for _, annotations in shard]).astype(np.int64),
+        }
+
+        # numeric and boolean columns are stored as they are, everything else as text with a missing mask
+        for idx, column in enumerate(frame.columns):
+            values = frame[column]
+            missing = values.isna().to_numpy()
+            if values.dtype.kind in "biuf":
+                arrays[f"col{idx}"] = values.to_numpy()
+            else:
+                arrays[f"col{idx}"] = np.array(["" if m else str(v) for v, m in zip(values, missing)], dtype=str)
+            arrays[f"na{idx}"] = missing
+
+        np.savez_compressed(os.path.join(self.store_dir, shard_name), **arrays)
+        for position, (name, _) in enumerate(shard):
+            index[name] = {"shard": shard_name, "position": position}
+
+    def _get_index(self)->dict:
+        """
+        Get the index of the stored files, reading it on first use.
+
+        :return: dictionary of file names and their shard and position.
+        """
+        if self._index is None:
+            with open(os.path.join(self.store_dir, self.INDEX_NAME)) as f:
+                self._index = json.load(f)["files"]
+        return self._index
+
+
+@lru_cache(maxsize=2)
+def _read_shard(shard_path:str, mtime_ns:int)->dict:
+    """
+    Read all arrays of a shard. The last shards are cached, so consecutive files of one shard are decompressed once.
+
+    :param shard_path: path to the shard.
+    :param mtime_ns: modification time of the shard, part of the cache key.
+    :return: dictionary of the shard arrays.
+    """
+    with np.load(shard_path, allow_pickle=False) as data:
+        return {key: data[key] for key in data.files}
+
+
+def list_annotation_files(ann_dir:str)->list[str]:
+    """
+    List the annotation files of a directory. For a store the stored files are listed as
+    paths inside the store directory, which load_annotations and load_annotation_frame understand.
+
+    :param ann_dir: path to the annotations directory or a store.
+    :return: sorted annotation file paths.
+    """
+    if SpaStore.is_store(ann_dir):
+        return [os.path.join(ann_dir, name) for name in SpaStore(ann_dir).names()]
+    return sorted(glob(os.path.join(ann_dir, "*.csv")))
+
+
+def load_annotations(ann_file:str)->SpaAnnotations:
+    """
+    Load and parse an annotation file from a csv file or a store.
+
+    :param ann_file: path to the annotation file as returned by list_annotation_files.
+    :return: parsed annotations.
+    """
+    store = _find_store(ann_file)
+    if store is not None:
+        return store.load(os.path.basename(ann_file))
+    return SpaAnnotations.from_csv(ann_file)
+
+
+def load_annotation_frame(ann_file:str)->pd.DataFrame:
+    """
+    Load the rows of an annotation file from a csv file or a store without parsing the vertices.
+
+    :param ann_file: path to the annotation file as returned by list_annotation_files.
+    :return: pandas dataframe with the annotation rows.
+    """
+    store = _find_store(ann_file)
+    if store is not None:
+        return store.load_frame(os.path.basename(ann_file))
+    return pd.read_csv(ann_file)
+
+
+def annotation_source_path(ann_file:str)->str:
+    """
+    Get the file on disk an annotation file is read from, the shard for stored files.
+
+    :param ann_file: path to the annotation file as returned by list_annotation_files.
+    :return: path to the csv file or the shard.
+    """
+    store = _find_store(ann_file)
+    if store is not None:
+        return store.shard_path(os.path.basename(ann_file))
+    return ann_file
+
+
+def _find_store(ann_file:str)->SpaStore|None:
+    """
+    Get the store of a stored annotation file.
+
+    :param ann_file: path to the annotation file.
+    :return: the store, None for csv files.
+    """
+    store_dir = os.path.dirname(ann_file)
+    if os.path.isfile(ann_file) or not SpaStore.is_store(store_dir):
+        return None
+    return _get_store(store_dir, os.stat(os.path.join(store_dir, SpaStore.INDEX_NAME)).st_mtime_ns)
+
+
+@lru_cache(maxsize=8)
+def _get_store(store_dir:str, mtime_ns:int)->SpaStore:
+    """
+    Get a store instance, so its index is read once per process.
+
+    :param store_dir: path to the store directory.
+    :param mtime_ns: modification time of the index, part of the cache key.
+    :return: the store.
+    """
+    return SpaStore(store_dir)
@@ -0,0 +1,125 @@
+import numpy as np
+
+# characters of a number, whitespace and commas separate numbers
+_NUMERIC = np.zeros(256, dtype=bool)
+_NUMERIC[list(b"0123456789.+-eE")] = True
+_SEPARATOR = np.zeros(256, dtype=bool)
+_SEPARATOR[list(b", \t\r\n")] = True
+
+# brackets, commas and numbers in the order of the checks of the list syntax
+_OPEN, _COMMA, _CLOSE, _NUMBER = 1, 2, 3, 4
+_MARK = np.zeros(256, dtype=np.uint8)
+_MARK[ord("[")], _MARK[ord(",")], _MARK[ord("]")] = _OPEN, _COMMA, _CLOSE
+
+
+def parse_vertices(texts)->tuple[np.ndarray, np.ndarray, np.ndarray, dict]:
+    """
+    Parse a column of S3A vertex strings like "[[[x, y], [x, y], ...], [[x, y], ...]]" in one pass.
+    Every entry is a list of rings and every ring a list of x, y points. All entries are joined
+    into one byte buffer, the bracket depth and the numbers are found with array operations and
+    the numbers are converted in a single call. Rows that can't be parsed get no rings.
+
+    :param texts: sequence of vertex strings, one per row. Missing values are reported as errors.
+    :return: (N, 2) array with the vertices of all rings back to back, (R + 1,) offsets so ring r owns
+        vertices[offsets[r]:offsets[r + 1]], (R,) row of every ring and a dictionary of the rows
+        that failed and their error messages.
+    """
+    texts = list(texts)
+    errors = {}
+    for row, text in enumerate(texts):
+        if not isinstance(text, str):
+            errors[row] = "missing vertices"
+            texts[row] = ""
+
+    # join the rows with a separator, non ascii characters become "?" so positions stay valid
+    lengths = np.array([len(text) for text in texts], dtype=np.int64)
+    starts = np.cumsum(lengths + 1) - (lengths + 1)
+    chars = np.frombuffer(" ".join(texts).encode("ascii", "replace"), dtype=np.uint8)
+    char_row = np.repeat(np.arange(len(texts)), lengths + 1)[:len(chars)]
+    in_row = np.ones(len(chars), dtype=bool)
+    in_row[(starts + lengths)[:-1]] = False
+
+    # bracket depth of every character relative to the start of its row
+    opens = chars == ord("[")
+    closes = chars == ord("]")
+    depth = np.cumsum(opens.astype(np.int64) - closes)
+    row_base = np.concatenate(([0], depth))[starts]
+    depth -= row_base[char_row]
+
+    # a number starts at every numeric character that doesn't follow another one
+    numeric = _NUMERIC[chars]
+    token_pos = np.flatnonzero(numeric & ~np.r_[False, numeric[:-1]])
+    token_row = char_row[token_pos]
+    values, bad_tokens = convert_numbers(np.where(numeric, chars, ord(" ")).astype(np.uint8).tobytes())
+
+    # rings open at depth 2 and points at depth 3, every number belongs to the last opened point
+    ring_open = opens & (depth == 2)
+    point_open = opens & (depth == 3)
+    ring_of_point = np.cumsum(ring_open)[point_open] - 1
+    point_of_token = np.cumsum(point_open)[token_pos] - 1
+    point_row = char_row[point_open]
+    coordinates = np.bincount(point_of_token[depth[token_pos] == 3], minlength=point_row.size)
+
+    # like in a python list, values are separated by exactly one comma and only a trailing comma may
+    # close a list: look at every pair of neighbouring brackets, commas and numbers of a row
+    mark = _MARK[chars]
+    mark[token_pos] = _NUMBER
+    marks = np.flatnonzero(mark)
+    kinds = mark[marks]
+    before, after = kinds[:-1], kinds[1:]
+    same_row = char_row[marks[:-1]] == char_row[marks[1:]]
+    missing_comma = marks[1:][same_row & (before >= _CLOSE) & (after != _COMMA) & (after != _CLOSE)]
+    empty_comma = marks[1:][(after == _COMMA) & (~same_row | (before <= _COMMA))]
+    first_comma = marks[:1][kinds[:1] == _COMMA]
+
+    # gather the structural problems of every row
+    count = len(texts)
+    end_depth = depth[starts + lengths - 1] if len(chars) else np.zeros(count, dtype=np.int64)
+    problems = [
+        (np.bincount(char_row[in_row & ~(numeric | opens | closes | _SEPARATOR[chars])], minlength=count), "unexpected character"),
+        (np.bincount(char_row[in_row & (depth < 0)], minlength=count) + ((lengths > 0) & (end_depth != 0)), "unbalanced brackets"),
+        (np.bincount(char_row[missing_comma], minlength=count), "missing comma"),
+        (np.bincount(char_row[np.r_[first_comma, empty_comma]], minlength=count), "comma without a value"),
+        (np.bincount(char_row[in_row & (depth > 3)], minlength=count), "points must be lists of x and y"),
+        (np.bincount(token_row[depth[token_pos] != 3], minlength=count), "number outside of a point"),
+        (np.bincount(point_row[coordinates != 2], minlength=count), "points must have exactly two coordinates"),
+        (np.bincount(token_row[bad_tokens], minlength=count), "invalid number"),
+        (np.bincount(char_row[opens & (depth == 1)], minlength=count) != 1, "expected one list of rings"),
+    ]
+    for flags, message in problems:
+        for row in np.flatnonzero(flags):
+            errors.setdefault(int(row), f"{message}: {texts[row][:40]!r}")
+
+    # keep the rings and vertices of the valid rows
+    valid = np.ones(count, dtype=bool)
+    valid[list(errors)] = False
+    kept_rings = valid[char_row[ring_open]]
+    kept_points = valid[point_row]
+    sizes = np.bincount(ring_of_point[kept_points], minlength=int(ring_open.sum()))[kept_rings]
+    offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=offsets[1:])
+    vertices = values[valid[token_row]].reshape(-1, 2)
+    return vertices, offsets, char_row[ring_open][kept_rings].astype(np.int64), dict(sorted(errors.items()))
+
+
+def convert_numbers(buffer:bytes)->tuple[np.ndarray, np.ndarray]:
+    """
+    Convert the whitespace separated numbers of a buffer to floats.
+
+    :param buffer: ascii buffer with numbers separated by spaces.
+    :return: array of the numbers (NaN for invalid ones) and a boolean mask of the invalid numbers.
+    """
+    tokens = buffer.split()
+    try:
+        return np.array(tokens, dtype=np.float64), np.zeros(len(tokens), dtype=bool)
+    except ValueError:
+        pass
+
+    # only on failure every number is converted separately to find the invalid ones
+    values = np.empty(len(tokens))
+    for idx, token in enumerate(tokens):
+        try:
+            values[idx] = float(token)
+        except ValueError:
+            values[idx] = np.nan
+    return values, np.isnan(values)
@@ -0,0 +1,106 @@
+import time
+import queue
+import threading
+
+from tqdm import tqdm
+
+from process_pool import report_failure
+
+# marks the end of the items in a queue
+_DONE = object()
+
+
+class Stage:
+    """
+    Step of a stage graph, run by its own pool of threads.
+    """
+
+    def __init__(self, name:str, func, workers:int=1):
+        """
+        :param name: name of the stage in the report.
+        :param func: callable taking one item and returning an iterable of items for the next stage.
+            Items are tuples whose first element names the sample in failure reports.
+        :param workers: number of threads running the stage.
+        """
+        self.name = name
+        self.func = func
+        self.workers = workers
+
+
+def run_stages(items:list, stages:list[Stage], queue_size:int=8)->tuple[dict, dict]:
+    """
+    Stream items through a chain of stages. Neighbouring stages are connected by bounded queues,
+    so every stage works on other samples at the same time while only a few items per stage are
+    held in memory. A failing item is reported and doesn't abort the other items.
+
+    :param items: items for the first stage.
+    :param stages: stages in the order they are applied.
+    :param queue_size: maximum number of items waiting in front of a stage.
+    :return: run time and statistics per stage, and a dictionary of failed items and their error messages.
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    stats = {stage.name: {"items": 0, "outputs": 0, "busy_s": 0.0} for stage in stages}
+    failures = {}
+    lock = threading.Lock()
+    remaining = [stage.workers for stage in stages]
+    pbar = tqdm(total=len(items))
+
+    def work(idx:int):
+        stage = stages[idx]
+        inbox = queues[idx]
+        outbox = queues[idx + 1] if idx + 1 < len(stages) else None
+        while True:
+            item = inbox.get()
+            if item is _DONE:
+                break
+
+            # the busy time excludes waiting for the next stage
+            busy = 0.0
+            outputs = 0
+            start = time.perf_counter()
+            try:
+                for output in stage.func(item):
+                    busy += time.perf_counter() - start
+                    outputs += 1
+                    if outbox is not None:
+                        outbox.put(output)
+                    start = time.perf_counter()
+                busy += time.perf_counter() - start
+            except Exception as e:
+                busy += time.perf_counter() - start
+                with lock:
+                    report_failure(failures, f"{stage.name} {item[0]}", e)
+
+            with lock:
+                stats[stage.name]["items"] += 1
+                stats[stage.name]["outputs"] += outputs
+                stats[stage.name]["busy_s"] += busy
+                if idx == 0:
+                    pbar.update(1)
+
+        # the last worker of a stage ends the next stage
+        with lock:
+            remaining[idx] -= 1
+            last = remaining[idx] == 0
+        if last and outbox is not None:
+            for _ in range(stages[idx + 1].workers):
+                outbox.put(_DONE)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=work, args=(idx,)) for idx, stage in enumerate(stages) for _ in range(stage.workers)]
+    for thread in threads:
+        thread.start()
+    for item in items:
+        queues[0].put(item)
+    for _ in range(stages[0].workers):
+        queues[0].put(_DONE)
+    for thread in threads:
+        thread.join()
+    pbar.close()
+
+    # throughput of every stage over the whole run
+    elapsed = time.perf_counter() - started
+    for stage in stages:
+        stats[stage.name]["items_per_s"] = stats[stage.name]["items"] / elapsed if elapsed > 0 else 0.0
+        stats[stage.name]["utilization"] = stats[stage.name]["busy_s"] / (elapsed * stage.workers) if elapsed > 0 else 0.0
+    return {"total_s": elapsed, "stages": stats}, failures
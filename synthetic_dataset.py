@@ -0,0 +1,78 @@
+import os
+
+import numpy as np
+import pandas as pd
+import cv2
+
+# designators of the FPIC dataset, the most frequent first
+DESIGNATORS = ["R", "C", "U", "Q", "J", "L", "RA", "D", "RN", "TP", "IC", "P", "CR", "M", "BTN", "FB", "CRA", "SW", "T", "F", "V", "LED", "S", "QA", "JP"]
+
+
+def generate_board(output_dir:str, name:str, width:int=4000, height:int=3000, polygons:int=500, vertices:int=16,
+                   designated:float=0.8, seed:int=0)->tuple[str, str]:
+    """
+    Generate a synthetic FPIC-like board image with an S3A annotation file.
+    Components are star shaped polygons scattered over a green board, a fraction of them has a designator.
+
+    :param output_dir: path to the output directory, the image goes to img/ and the annotations to ann/.
+    :param name: name of the board without extension.
+    :param width: width of the image.
+    :param height: height of the image.
+    :param polygons: number of annotated components.
+    :param vertices: number of vertices per polygon.
+    :param designated: fraction of the components with a designator.
+    :param seed: seed of the random generator.
+    :return: paths of the image and the annotation file.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(f"{output_dir}/img", exist_ok=True)
+    os.makedirs(f"{output_dir}/ann", exist_ok=True)
+
+    # noisy board background, so the images compress like photographs
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    image[:] = (40, 110, 30)
+    image += rng.integers(0, 24, (height, width, 1), dtype=np.uint8)
+
+    # star shaped polygons: vertices on a circle with random radii
+    radius = rng.uniform(8, max(9, min(width, height) / 40), polygons)
+    centers = rng.uniform(radius[:, None], np.array([width, height]) - radius[:, None])
+    angles = np.sort(rng.uniform(0, 2 * np.pi, (polygons, vertices)), axis=1)
+    radii = radius[:, None] * rng.uniform(0.6, 1.0, (polygons, vertices))
+    points = np.stack((np.cos(angles), np.sin(angles)), axis=2) * radii[:, :, None] + centers[:, None, :]
+    points = np.rint(points).astype(np.int32)
+
+    colors = rng.integers(0, 256, (polygons, 3))
+    for polygon, color in zip(points, colors):
+        cv2.fillPoly(image, [polygon], tuple(int(c) for c in color))
+
+    image_name = f"{name}.png"
+    image_path = f"{output_dir}/img/{image_name}"
+    cv2.imwrite(image_path, image)
+
+    # S3A annotation file, components without a designator have an empty cell
+    designators = np.array(DESIGNATORS, dtype=object)[rng.integers(0, len(DESIGNATORS), polygons)]
+    designators[rng.random(polygons) >= designated] = None
+    frame = pd.DataFrame({
+        "Instance ID": np.arange(polygons),
+        "Image File": image_name,
+        "Vertices": [str([polygon.tolist()]) for polygon in points],
+        "Validated": True,
+        "Designator": designators,
+        "Notes": None,
+    })
+    ann_path = f"{output_dir}/ann/{name}.csv"
+    frame.to_csv(ann_path, index=False)
+    return image_path, ann_path
+
+
+def generate_dataset(output_dir:str, boards:int=4, seed:int=0, **board_options)->list[tuple[str, str]]:
+    """
+    Generate a synthetic dataset of several boards.
+
+    :param output_dir: path to the output directory.
+    :param boards: number of boards.
+    :param seed: seed of the first board, the following boards use the next seeds.
+    :param board_options: options of generate_board, e.g. width, height, polygons and vertices.
+    :return: paths of the images and the annotation files.
+    """
+    return [generate_board(output_dir, f"board_{idx:04d}", seed=seed + idx, **board_options) for idx in range(boards)]